@@ -0,0 +1,176 @@
+import numpy as np
+from SparseTransitionMatrix import SparseTransitionMatrix
+from Vocabulary import N_PITCHES, masks_to_sounding
+
+PITCH_CLASS_NAMES = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+_FLAT_NAMES = {'Db': 1, 'Eb': 3, 'Gb': 6, 'Ab': 8, 'Bb': 10, 'Cb': 11, 'Fb': 4}
+
+# Scale degrees in semitones above the tonic; minor keys allow both the natural and the raised seventh
+MAJOR_SCALE = (0, 2, 4, 5, 7, 9, 11)
+MINOR_SCALE = (0, 2, 3, 5, 7, 8, 10, 11)
+
+# Keys 0-11 are C major to B major, keys 12-23 C minor to B minor
+KEY_NAMES = tuple(f'{name} major' for name in PITCH_CLASS_NAMES) + tuple(f'{name} minor' for name in PITCH_CLASS_NAMES)
+
+def pitch_classes_to_mask(pitch_classes) -> int:
+    """
+    :param pitch_classes: Iterable of pitch classes (0 = C, ..., 11 = B).
+    :return: 12-bit mask with bit c set for every pitch class c.
+    """
+    mask = 0
+    for pitch_class in pitch_classes:
+        mask |= 1 << (pitch_class % 12)
+    return mask
+
+def parse_key(key: str) -> int:
+    """
+    Parse a key name such as 'C', 'F# major', 'Bb minor' or 'Am'.
+    :param key: Key name. Without a mode, a major key.
+    :return: Index of the key in KEY_NAMES.
+    :raises ValueError: If the key name is not recognized.
+    """
+    words = key.strip().split()
+    if not words:
+        raise ValueError('Empty key name')
+    tonic, mode = words[0], words[1].lower() if len(words) == 2 else 'major'
+    if len(words) == 1 and len(tonic) > 1 and tonic[-1] == 'm':
+        tonic, mode = tonic[:-1], 'minor'
+    tonic = tonic[0].upper() + tonic[1:]
+
+    if tonic in PITCH_CLASS_NAMES:
+        pitch_class = PITCH_CLASS_NAMES.index(tonic)
+    elif tonic in _FLAT_NAMES:
+        pitch_class = _FLAT_NAMES[tonic]
+    else:
+        raise ValueError(f"Unknown key '{key}'")
+    if len(words) > 2 or mode not in ('major', 'minor'):
+        raise ValueError(f"Unknown key '{key}', expected e.g. 'C major' or 'A minor'")
+
+    return pitch_class + (12 if mode == 'minor' else 0)
+
+def _key_scale_masks() -> np.ndarray:
+    """
+    :return: 12-bit pitch-class mask of the scale of every key in KEY_NAMES.
+    """
+    return np.array([pitch_classes_to_mask(tonic + degree for degree in scale)
+                     for scale in (MAJOR_SCALE, MINOR_SCALE) for tonic in range(12)], dtype=np.uint16)
+
+class MaskedRows:
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, counts: np.ndarray, column_weights: np.ndarray):
+        """
+        Rows of a CSR count matrix with every column weighted, renormalized on the fly. Weighting the columns
+        by an allowed-state mask removes forbidden next states from every row at once; weighting them by the
+        backward messages of an end constraint conditions every row on reaching the end.
+        Building the tables is one pass over the stored counts, so constraints cost about as much as a step.
+        :param indptr: Row pointer array.
+        :param indices: Column (next state) index of every stored count.
+        :param counts: Count of every stored entry.
+        :param column_weights: Non-negative weight of every column. Zero removes the column.
+        """
+        self._indptr = indptr
+        self._indices = indices
+        weighted_counts = counts * column_weights[indices]
+        self._cumulative_counts = np.cumsum(weighted_counts, dtype=np.float64)
+        row_bounds = np.concatenate(([0.0], self._cumulative_counts))[indptr]
+        self.row_offsets = row_bounds[:-1]
+        self.row_totals = row_bounds[1:] - row_bounds[:-1]
+
+        # Rounding may push a search past the row's last entry; it is clamped to the last entry with weight
+        positive = np.flatnonzero(weighted_counts > 0)
+        last_positive = np.searchsorted(positive, indptr[1:]) - 1
+        self._last_positive = positive[np.maximum(last_positive, 0)] if len(positive) > 0 else np.zeros(len(indptr) - 1, dtype=np.int64)
+
+    def sample(self, rows: np.ndarray, x: np.ndarray) -> np.ndarray:
+        """
+        Draw the columns of rows with a positive total.
+        :param rows: Row index of every draw.
+        :param x: Draws in [0, row_totals[rows]).
+        :return: Array of column indices.
+        """
+        positions = np.searchsorted(self._cumulative_counts, self.row_offsets[rows] + x, side='right')
+        return self._indices[np.minimum(positions, self._last_positive[rows])]
+
+class ConstraintIndex:
+    def __init__(self, state_masks: np.ndarray, transition_matrix: SparseTransitionMatrix):
+        """
+        Musical properties of every state of a model, for answering constraints like "in key X" or
+        "avoid these pitches" with one vectorized test over the states instead of rejection sampling.
+        :param state_masks: Array of shape (n_states, 2) of the pitch-set masks of the states (see Vocabulary).
+        :param transition_matrix: First-order transition counts of the model, giving the observed successors of every state.
+        """
+        self.sounding = masks_to_sounding(state_masks)
+        self.is_rest = ~self.sounding.any(axis=1)
+
+        # Fold the pitches onto the 12 pitch classes; padding to a multiple of 12 adds no pitches
+        padded = np.zeros((len(state_masks), -(-N_PITCHES // 12) * 12), dtype=bool)
+        padded[:, :N_PITCHES] = self.sounding
+        pitch_class_flags = padded.reshape(len(state_masks), -1, 12).any(axis=1)
+        self.pitch_classes = (pitch_class_flags * (1 << np.arange(12))).sum(axis=1).astype(np.uint16)
+
+        # A state fits a key if all of its pitch classes are in the key's scale; rests fit every key
+        self.key_compatible = (self.pitch_classes[:, None] & ~_key_scale_masks()[None, :]) == 0
+        self._transition_matrix = transition_matrix
+
+    @property
+    def n_states(self) -> int:
+        return len(self.pitch_classes)
+
+    def allowed_states(self, key: str | None = None, pitch_classes=None, avoid_pitches=None,
+                       pitch_range: tuple[int, int] | None = None, allow_rests: bool = True) -> np.ndarray:
+        """
+        Select the states satisfying all given constraints.
+        :param key: Only states whose pitches are all in the scale of this key (see parse_key()).
+        :param pitch_classes: Only states whose pitch classes are all among these (0 = C, ..., 11 = B), e.g. a chord.
+        :param avoid_pitches: MIDI pitches no state may contain.
+        :param pitch_range: Inclusive (lowest, highest) MIDI pitch of all states.
+        :param allow_rests: Whether rests are allowed.
+        :return: Boolean array over the state ids.
+        """
+        allowed = np.ones(self.n_states, dtype=bool)
+
+        if key is not None:
+            allowed &= self.key_compatible[:, parse_key(key)]
+        if pitch_classes is not None:
+            allowed &= (self.pitch_classes & ~np.uint16(pitch_classes_to_mask(pitch_classes))) == 0
+        if avoid_pitches is not None:
+            allowed &= ~self.sounding[:, list(avoid_pitches)].any(axis=1)
+        if pitch_range is not None:
+            lowest, highest = pitch_range
+            outside = np.ones(N_PITCHES, dtype=bool)
+            outside[max(lowest, 0):min(highest, N_PITCHES - 1) + 1] = False
+            allowed &= ~self.sounding[:, outside].any(axis=1)
+        if not allow_rests:
+            allowed &= ~self.is_rest
+
+        return allowed
+
+    def compatible_keys(self, state_ids: np.ndarray) -> list[str]:
+        """
+        Keys all given states fit in, e.g. to continue a phrase in its own key.
+        :param state_ids: Array of state ids.
+        :return: Names of the compatible keys, see KEY_NAMES.
+        """
+        compatible = self.key_compatible[np.asarray(state_ids)].all(axis=0)
+        return [KEY_NAMES[key_index] for key_index in np.flatnonzero(compatible)]
+
+    def successors(self, state_id: int) -> np.ndarray:
+        """
+        :param state_id: State id.
+        :return: State ids observed to follow the state. Smoothing makes every other state reachable with a small probability.
+        """
+        tm = self._transition_matrix
+        return tm.indices[tm.indptr[state_id]:tm.indptr[state_id + 1]]
+
+    def n_allowed_successors(self, allowed: np.ndarray) -> np.ndarray:
+        """
+        Count the observed successors of every state that are allowed, e.g. to find the dead ends of a constraint.
+        :param allowed: Boolean array over the state ids.
+        :return: Number of allowed observed successors of every state.
+        """
+        tm = self._transition_matrix
+        allowed_entries = np.concatenate(([0], np.cumsum(allowed[tm.indices], dtype=np.int64)))
+        return allowed_entries[tm.indptr[1:]] - allowed_entries[tm.indptr[:-1]]
+
+    @property
+    def nbytes(self) -> int:
+        return self.sounding.nbytes + self.is_rest.nbytes + self.pitch_classes.nbytes + self.key_compatible.nbytes
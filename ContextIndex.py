@@ -0,0 +1,113 @@
+import numpy as np
+
+_FNV_OFFSET = np.uint64(0xCBF29CE484222325)
+_FNV_PRIME = np.uint64(0x100000001B3)
+
+def hash_contexts(contexts: np.ndarray) -> np.ndarray:
+    """
+    Hash contexts of state ids into 64-bit keys (FNV-1a over the ids, newest first).
+    Hashing newest first lets the key of a context be extended one older state at a time with extend_hashes().
+    :param contexts: Array of shape (n, order) with the state ids of every context, oldest first.
+    :return: Array of n uint64 keys.
+    """
+    hashes = np.full(len(contexts), _FNV_OFFSET, dtype=np.uint64)
+
+    for column in range(contexts.shape[1] - 1, -1, -1):
+        hashes = extend_hashes(hashes, contexts[:, column])
+
+    return hashes
+
+def extend_hashes(hashes: np.ndarray, older_ids: np.ndarray) -> np.ndarray:
+    """
+    Extend context keys by one state older than the states they already cover.
+    :param hashes: Array of uint64 keys.
+    :param older_ids: State id to add to every key.
+    :return: Array of extended uint64 keys.
+    """
+    return (hashes ^ older_ids.astype(np.uint64)) * _FNV_PRIME
+
+class ContextIndex:
+    # Arrays derived from the counts for sampling; saved alongside them so loading skips the rebuild
+    SAMPLING_TABLES = ('cumulative_counts', 'row_offsets', 'row_totals')
+
+    def __init__(self, order: int, keys: np.ndarray, indptr: np.ndarray, indices: np.ndarray, counts: np.ndarray,
+                 sampling_tables: dict[str, np.ndarray] | None = None):
+        """
+        Next-state counts of all observed contexts of one order, addressed by the hash of the context.
+        Rows are stored in CSR form, sorted by key, so a context is found with one binary search.
+        Contexts are only ever used when observed, so no smoothing is applied at this level.
+        :param order: Number of states in every context.
+        :param keys: Sorted uint64 hash of every context.
+        :param indptr: Row pointer array of length len(keys) + 1.
+        :param indices: Next state id of every stored count.
+        :param counts: Observed count of every stored entry.
+        :param sampling_tables: Precomputed sampling tables, e.g. memory-mapped from a saved model. Built if None.
+        """
+        self.order = order
+        self.keys = keys
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+
+        if sampling_tables is None:
+            self.cumulative_counts = np.cumsum(counts, dtype=np.float64)
+            row_bounds = np.concatenate(([0.0], self.cumulative_counts))[indptr]
+            self.row_offsets = row_bounds[:-1]
+            self.row_totals = row_bounds[1:] - row_bounds[:-1]
+        else:
+            for name in self.SAMPLING_TABLES:
+                setattr(self, name, sampling_tables[name])
+
+    @classmethod
+    def from_ngrams(cls, ngrams: np.ndarray, counts: np.ndarray) -> 'ContextIndex':
+        """
+        Build the index from distinct n-grams and their counts.
+        :param ngrams: Array of shape (n, order + 1): the context state ids, oldest first, followed by the next state id.
+        :param counts: Number of times every n-gram was observed.
+        :return: ContextIndex of order ngrams.shape[1] - 1.
+        """
+        order = ngrams.shape[1] - 1
+        keys = hash_contexts(ngrams[:, :order])
+        next_ids = ngrams[:, order]
+
+        # Sort by (key, next state) and merge entries that only differ by a hash collision
+        sort_order = np.lexsort((next_ids, keys))
+        keys, next_ids, counts = keys[sort_order], next_ids[sort_order], counts[sort_order]
+        is_new_entry = np.ones(len(keys), dtype=bool)
+        is_new_entry[1:] = (keys[1:] != keys[:-1]) | (next_ids[1:] != next_ids[:-1])
+        entry_starts = np.flatnonzero(is_new_entry)
+        counts = np.add.reduceat(counts, entry_starts) if len(counts) > 0 else counts
+        keys, next_ids = keys[entry_starts], next_ids[entry_starts]
+
+        unique_keys, row_starts = np.unique(keys, return_index=True)
+        indptr = np.append(row_starts, len(keys)).astype(np.int64)
+
+        return cls(order, unique_keys, indptr, next_ids.astype(np.int32), counts.astype(np.int64))
+
+    def lookup(self, hashes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows of contexts.
+        :param hashes: Array of uint64 context keys.
+        :return: Tuple of (row index of every key, mask of keys that were found). Rows of missing keys are meaningless.
+        """
+        rows = np.minimum(np.searchsorted(self.keys, hashes), max(len(self.keys) - 1, 0))
+        found = self.keys[rows] == hashes if len(self.keys) > 0 else np.zeros(len(hashes), dtype=bool)
+        return rows, found
+
+    def sample(self, rows: np.ndarray, uniforms: np.ndarray) -> np.ndarray:
+        """
+        Draw the next state of found contexts.
+        :param rows: Row index of every context.
+        :param uniforms: Uniform random numbers in [0, 1), same shape as rows.
+        :return: Array of next state ids.
+        """
+        targets = self.row_offsets[rows] + uniforms * self.row_totals[rows]
+        positions = np.searchsorted(self.cumulative_counts, targets, side='right')
+        # Clamp to the row's last entry in case floating point rounding pushed the search past it
+        positions = np.minimum(positions, self.indptr[rows + 1] - 1)
+        return self.indices[positions]
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.keys, self.indptr, self.indices, self.counts] + [getattr(self, name) for name in self.SAMPLING_TABLES]
+        return sum(array.nbytes for array in arrays)
@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+from contextlib import nullcontext
+
+# The active recorder; None disables instrumentation, so every hook is a single check
+_recorder = None
+
+# Returned by stage() while disabled, so timing a stage allocates nothing
+_NULL_STAGE = nullcontext()
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process and its finished children so far, in MiB.
+    """
+    self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return max(self_peak, children_peak) / scale
+
+class _Stage:
+    """
+    Context manager timing one stage and reporting it to a recorder, together with the peak RSS after it.
+    """
+    __slots__ = ('_recorder', '_name', '_labels', '_start')
+
+    def __init__(self, recorder: 'Recorder', name: str, labels: dict):
+        self._recorder = recorder
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._recorder.record_stage(self._name, time.perf_counter() - self._start, **self._labels)
+
+class Recorder:
+    def __init__(self, sinks: list):
+        """
+        Collects stage timings, counters and gauges and passes every event on to the sinks.
+        Events are dicts with 'type' ('stage', 'counter' or 'gauge'), 'name', 'labels', 'value' and 'time';
+        stage events also carry 'peak_rss_mb'.
+        :param sinks: Objects with emit(event) and close() methods, e.g. LoggingSink, JsonLinesSink or PrometheusSink.
+        """
+        self._sinks = list(sinks)
+        self._lock = threading.Lock()
+
+    def _emit(self, event: dict) -> None:
+        event['time'] = time.time()
+        with self._lock:
+            for sink in self._sinks:
+                sink.emit(event)
+
+    def stage(self, name: str, **labels) -> _Stage:
+        return _Stage(self, name, labels)
+
+    def record_stage(self, name: str, seconds: float, **labels) -> None:
+        """
+        Report a stage timed elsewhere, e.g. inside a worker process.
+        """
+        self._emit({'type': 'stage', 'name': name, 'labels': labels, 'value': seconds, 'peak_rss_mb': peak_rss_mb()})
+
+    def count(self, name: str, value: int = 1, **labels) -> None:
+        self._emit({'type': 'counter', 'name': name, 'labels': labels, 'value': value})
+
+    def gauge(self, name: str, value: float, **labels) -> None:
+        self._emit({'type': 'gauge', 'name': name, 'labels': labels, 'value': value})
+
+    def close(self) -> None:
+        with self._lock:
+            for sink in self._sinks:
+                sink.close()
+
+class LoggingSink:
+    def __init__(self, logger: logging.Logger | None = None, level: int = logging.INFO):
+        """
+        Logs every event as one line.
+        :param logger: Logger to write to. The 'MusicGenerator' logger if None.
+        :param level: Log level of the events.
+        """
+        self._logger = logger if logger is not None else logging.getLogger('MusicGenerator')
+        self._level = level
+
+    def emit(self, event: dict) -> None:
+        labels = ' '.join(f'{key}={value}' for key, value in event['labels'].items())
+        if event['type'] == 'stage':
+            self._logger.log(self._level, '%s %.6fs peak RSS %.1f MiB %s', event['name'], event['value'],
+                             event['peak_rss_mb'], labels)
+        else:
+            self._logger.log(self._level, '%s %s=%s %s', event['type'], event['name'], event['value'], labels)
+
+    def close(self) -> None:
+        pass
+
+class JsonLinesSink:
+    def __init__(self, path: str):
+        """
+        Appends every event to a file as one JSON object per line.
+        :param path: Path of the JSON lines file.
+        """
+        self._file = open(path, 'a', buffering=1)
+
+    def emit(self, event: dict) -> None:
+        self._file.write(json.dumps(event, default=str) + '\n')
+
+    def close(self) -> None:
+        self._file.close()
+
+class PrometheusSink:
+    def __init__(self, path: str, prefix: str = 'music_generator'):
+        """
+        Aggregates the events and writes them in the Prometheus text exposition format on close(),
+        e.g. for the node exporter's textfile collector. Stages become <prefix>_stage_seconds_total and
+        <prefix>_stage_calls_total, counters <prefix>_<name>_total and gauges <prefix>_<name>.
+        :param path: Path of the text file. Written atomically.
+        :param prefix: Prefix of every metric name.
+        """
+        self._path = path
+        self._prefix = prefix
+        self._metrics = {}
+        self._peak_rss_mb = 0.0
+
+    def emit(self, event: dict) -> None:
+        labels = tuple(sorted((key, str(value)) for key, value in event['labels'].items()))
+
+        if event['type'] == 'stage':
+            stage_labels = (('stage', event['name']),) + labels
+            self._add(f'{self._prefix}_stage_seconds_total', 'counter', stage_labels, event['value'])
+            self._add(f'{self._prefix}_stage_calls_total', 'counter', stage_labels, 1)
+            self._peak_rss_mb = max(self._peak_rss_mb, event['peak_rss_mb'])
+        elif event['type'] == 'counter':
+            self._add(f"{self._prefix}_{event['name']}_total", 'counter', labels, event['value'])
+        else:
+            self._metrics.setdefault(f"{self._prefix}_{event['name']}", ('gauge', {}))[1][labels] = event['value']
+
+    def _add(self, name: str, kind: str, labels: tuple, value: float) -> None:
+        samples = self._metrics.setdefault(name, (kind, {}))[1]
+        samples[labels] = samples.get(labels, 0) + value
+
+    def render(self) -> str:
+        """
+        :return: The aggregated metrics in the Prometheus text exposition format.
+        """
+        lines = [f'# TYPE {self._prefix}_peak_rss_megabytes gauge', f'{self._prefix}_peak_rss_megabytes {self._peak_rss_mb}']
+
+        for name, (kind, samples) in sorted(self._metrics.items()):
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(samples.items()):
+                label_text = ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"'))
+                                      for key, value in labels)
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def close(self) -> None:
+        tmp_path = f'{self._path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, self._path)
+
+def enable(*sinks) -> Recorder:
+    """
+    Start recording to the given sinks, replacing (and closing) any active recorder.
+    :param sinks: Sinks receiving the events.
+    :return: The active Recorder.
+    """
+    global _recorder
+    disable()
+    _recorder = Recorder(list(sinks))
+    return _recorder
+
+def disable() -> None:
+    """
+    Stop recording and close the sinks of the active recorder, e.g. to write a PrometheusSink's file.
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.close()
+
+def enabled() -> bool:
+    return _recorder is not None
+
+def stage(name: str, **labels):
+    """
+    Time a stage: with stage('analyze_data'): ... Does nothing while instrumentation is disabled.
+    """
+    return _recorder.stage(name, **labels) if _recorder is not None else _NULL_STAGE
+
+def record_stage(name: str, seconds: float, **labels) -> None:
+    if _recorder is not None:
+        _recorder.record_stage(name, seconds, **labels)
+
+def count(name: str, value: int = 1, **labels) -> None:
+    if _recorder is not None:
+        _recorder.count(name, value, **labels)
+
+def gauge(name: str, value: float, **labels) -> None:
+    if _recorder is not None:
+        _recorder.gauge(name, value, **labels)
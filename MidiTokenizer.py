@@ -0,0 +1,244 @@
+import heapq
+from functools import lru_cache
+from typing import Iterator
+import music21
+import numpy as np
+from Vocabulary import REST_MASK, masks_to_array, quarter_lengths_to_durations
+
+# Bump whenever iter_midi_tokens changes the tokens it produces, so stale cache entries are ignored
+MIDI_TOKENIZER_VERSION = '4'
+
+# MIDI channel 10 carries unpitched percussion, which _get_music_elements never turns into pitch tokens
+PERCUSSION_CHANNEL = 9
+
+# Onsets are snapped to the nearest sixteenth or eighth-triplet, like music21's default quantization
+QUANTIZATION_DIVISORS = (4, 3)
+
+def _read_variable_length(data: bytes, pos: int) -> tuple[int, int]:
+    """
+    Read a variable-length quantity from MIDI data.
+    :param data: MIDI file bytes.
+    :param pos: Position of the first byte of the quantity.
+    :return: Tuple of (value, position after the quantity).
+    """
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+def _iter_track_events(data: bytes, pos: int, end: int, track_index: int) -> Iterator[tuple[int, int, int, int, int]]:
+    """
+    Decode the note and program change events of one MTrk chunk, skipping everything else.
+    :param data: MIDI file bytes.
+    :param pos: Position of the first event of the track.
+    :param end: Position after the last byte of the track.
+    :param track_index: Index of the track, used to order simultaneous events of different tracks.
+    :return: Iterator of (tick, track_index, status, data1, data2) tuples in tick order.
+    """
+    tick = 0
+    running_status = 0
+
+    while pos < end:
+        delta, pos = _read_variable_length(data, pos)
+        tick += delta
+
+        status = data[pos]
+        if status >= 0x80:
+            pos += 1
+        else:
+            status = running_status
+
+        if status == 0xFF:
+            pos += 1
+            length, pos = _read_variable_length(data, pos)
+            pos += length
+            continue
+        if status in (0xF0, 0xF7):
+            length, pos = _read_variable_length(data, pos)
+            pos += length
+            continue
+
+        running_status = status
+        kind = status & 0xF0
+
+        if kind in (0xC0, 0xD0):
+            data1, data2 = data[pos], 0
+            pos += 1
+        else:
+            data1, data2 = data[pos], data[pos + 1]
+            pos += 2
+
+        if kind in (0x80, 0x90, 0xC0):
+            yield tick, track_index, status, data1, data2
+
+def _iter_events(data: bytes) -> tuple[int, Iterator[tuple[int, int, int, int, int]]]:
+    """
+    Split MIDI file bytes into chunks and merge the events of all tracks in tick order.
+    :param data: MIDI file bytes.
+    :return: Tuple of (ticks per quarter note, iterator of (tick, track_index, status, data1, data2) tuples).
+    :raises ValueError: If the data is not a Standard MIDI File, is truncated, has no tracks or uses SMPTE timing.
+    """
+    if data[:4] != b'MThd':
+        raise ValueError('Not a Standard MIDI File')
+
+    header_length = int.from_bytes(data[4:8], 'big')
+    if header_length < 6 or len(data) < 8 + header_length:
+        raise ValueError('Truncated or malformed MIDI header')
+    division = int.from_bytes(data[12:14], 'big')
+    if division == 0:
+        raise ValueError('MIDI header has a time division of 0')
+    if division & 0x8000:
+        raise ValueError('SMPTE time division is not supported')
+
+    tracks = []
+    pos = 8 + header_length
+    while pos + 8 <= len(data):
+        chunk_type = data[pos:pos + 4]
+        chunk_length = int.from_bytes(data[pos + 4:pos + 8], 'big')
+        chunk_end = min(pos + 8 + chunk_length, len(data))
+        if chunk_type == b'MTrk':
+            tracks.append(_iter_track_events(data, pos + 8, chunk_end, len(tracks)))
+        pos = chunk_end
+
+    if not tracks:
+        raise ValueError('No MTrk chunk found')
+
+    return division, heapq.merge(*tracks)
+
+def _quantize(tick: int, ticks_per_quarter: int) -> int:
+    """
+    Snap a tick to the nearest point of any of the quantization grids.
+    :param tick: Tick to quantize.
+    :param ticks_per_quarter: Ticks per quarter note of the file.
+    :return: Quantized tick.
+    """
+    candidates = []
+    for divisor in QUANTIZATION_DIVISORS:
+        step = ticks_per_quarter / divisor
+        candidates.append(round(round(tick / step) * step))
+
+    return min(candidates, key=lambda candidate: abs(candidate - tick))
+
+@lru_cache(maxsize=None)
+def program_to_instrument_name(program: int) -> str:
+    """
+    Get the music21 instrument name of a General MIDI program number.
+    :param program: MIDI program number (0-127).
+    :return: Instrument name.
+    """
+    try:
+        return music21.instrument.instrumentFromMidiProgram(program).instrumentName
+    except music21.exceptions21.InstrumentException:
+        return music21.instrument.Piano().instrumentName
+
+class _ProgramTokenizer:
+    """
+    Turns the quantized note-on/note-off events of one program into music elements (pitch-set masks)
+    and their durations. An element lasts until the next one starts; a rest starts when the last sounding note ends.
+    """
+    def __init__(self, ticks_per_quarter: int):
+        self.tokens = []
+        self._ticks_per_quarter = ticks_per_quarter
+        self._starts = []
+        self._onset_tick = None
+        self._onset_mask = 0
+        self._sounding = {}
+        self._release_tick = 0
+
+    def _flush(self) -> None:
+        """
+        Emit the note or chord started at the current onset tick, if any.
+        """
+        if not self._onset_mask:
+            return
+        self.tokens.append(self._onset_mask)
+        self._starts.append(self._onset_tick)
+        self._onset_mask = 0
+
+    def note_on(self, tick: int, pitch: int) -> None:
+        """
+        Add a note to the chord at this tick, or start a new element, preceded by a rest if nothing was sounding.
+        """
+        if self._onset_mask and tick == self._onset_tick:
+            self._onset_mask |= 1 << pitch
+        else:
+            self._flush()
+            if not self._sounding and tick > self._release_tick:
+                self.tokens.append(REST_MASK)
+                self._starts.append(self._release_tick)
+            self._onset_tick = tick
+            self._onset_mask = 1 << pitch
+        self._sounding[pitch] = self._sounding.get(pitch, 0) + 1
+
+    def note_off(self, tick: int, pitch: int) -> None:
+        """
+        Release a sounding note, remembering when the last sounding note ended.
+        """
+        count = self._sounding.get(pitch, 0)
+        if count == 0:
+            return
+        if count == 1:
+            del self._sounding[pitch]
+        else:
+            self._sounding[pitch] = count - 1
+        if not self._sounding:
+            self._release_tick = tick
+
+    def finish(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Emit the pending element and return all music elements.
+        :return: Tuple of (array of shape (n, 2) of pitch-set masks, array of n durations), see Vocabulary.
+        """
+        self._flush()
+        # The last element lasts until its notes are released
+        ends = self._starts[1:] + [max(self._release_tick, self._starts[-1])] if self._starts else []
+        quarter_lengths = (np.array(ends) - np.array(self._starts)) / self._ticks_per_quarter
+        return masks_to_array(self.tokens), quarter_lengths_to_durations(quarter_lengths)
+
+def iter_midi_tokens(midi_path: str) -> Iterator[tuple[str, np.ndarray, np.ndarray]]:
+    """
+    Tokenize a MIDI file directly from its chunks, without building music21 streams.
+    Produces the same tokens as MusicDataTrainer._get_music_elements: the pitch-set mask of every note,
+    chord (note-ons at the same quantized tick) and rest (a gap with no sounding note, the empty mask).
+    Notes are grouped by General MIDI program, like partitionByInstrument.
+    Token streams are close to, not identical with, music21's: notes split at barlines are not repeated,
+    instruments are named after their program rather than track names, percussion is skipped, and
+    overlapping notes last until the next onset rather than their own release.
+    :param midi_path: Path to the MIDI file.
+    :return: Iterator of (instrument name, array of shape (n, 2) of pitch-set masks, array of n durations) tuples,
+             one per program.
+    """
+    with open(midi_path, 'rb') as f:
+        data = f.read()
+
+    ticks_per_quarter, events = _iter_events(data)
+
+    # Programs are tracked per track and channel, since many files reuse one channel across tracks
+    programs = {}
+    tokenizers = {}
+
+    for tick, track_index, status, data1, data2 in events:
+        kind = status & 0xF0
+        channel = status & 0x0F
+
+        if channel == PERCUSSION_CHANNEL:
+            continue
+        if kind == 0xC0:
+            programs[track_index, channel] = data1
+            continue
+
+        program = programs.get((track_index, channel), 0)
+        if program not in tokenizers:
+            tokenizers[program] = _ProgramTokenizer(ticks_per_quarter)
+
+        quantized_tick = _quantize(tick, ticks_per_quarter)
+        if kind == 0x90 and data2 > 0:
+            tokenizers[program].note_on(quantized_tick, data1)
+        else:
+            tokenizers[program].note_off(quantized_tick, data1)
+
+    for program, tokenizer in tokenizers.items():
+        yield program_to_instrument_name(program), *tokenizer.finish()
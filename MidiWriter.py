@@ -0,0 +1,197 @@
+import numpy as np
+from Vocabulary import DURATION_RESOLUTION, MAX_DURATION, masks_to_sounding
+
+TICKS_PER_QUARTER = 480
+
+# Ticks of one duration unit; 480 ticks per quarter represent every duration unit exactly
+TICKS_PER_DURATION = TICKS_PER_QUARTER // DURATION_RESOLUTION
+
+# MIDI channel 10 is reserved for percussion, so pitched parts never use it
+PITCHED_CHANNELS = tuple(channel for channel in range(16) if channel != 9)
+
+def encode_variable_length(value: int) -> bytes:
+    """
+    Encode a MIDI variable-length quantity.
+    :param value: Non-negative integer.
+    :return: Encoded bytes.
+    """
+    encoded = [value & 0x7F]
+    value >>= 7
+    while value:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(encoded))
+
+class PitchTable:
+    def __init__(self, masks: np.ndarray):
+        """
+        MIDI pitches of every state id, unpacked once from the pitch-set masks of the states.
+        :param masks: Array of shape (n_states, 2) of pitch-set masks (see Vocabulary). The empty mask is a rest.
+        """
+        sounding = masks_to_sounding(masks)
+
+        # Rests have no pitches; chords are padded with -1
+        self.lengths = sounding.sum(axis=1).astype(np.int8)
+        self.pitches = np.full((len(masks), max(int(self.lengths.max(initial=0)), 1)), -1, dtype=np.int8)
+        state_ids, pitches = np.nonzero(sounding)
+        slots = np.arange(len(state_ids)) - np.repeat(np.cumsum(self.lengths, dtype=np.int64) - self.lengths, self.lengths)
+        self.pitches[state_ids, slots] = pitches
+
+class TrackWriter:
+    def __init__(self, pitch_table: PitchTable, channel: int = 0, velocity: int = 80, ticks_per_element: int = TICKS_PER_QUARTER):
+        """
+        Writes MTrk chunks straight from state ids. The note-on and note-off bytes of every state and the delta
+        time of every duration are precomputed, so writing a track is a few lookups and appends per element.
+        Without durations every element lasts ticks_per_element, like the quarter notes, chords and rests built
+        by MusicGenerator.
+        :param pitch_table: Pitches of every state id.
+        :param channel: MIDI channel of the track.
+        :param velocity: Note-on velocity.
+        :param ticks_per_element: Duration of every element in ticks when no durations are given.
+        """
+        self._channel = channel
+        self._ticks_per_element = ticks_per_element
+        self._element_delta = encode_variable_length(ticks_per_element)
+        self._duration_deltas = [encode_variable_length(duration * TICKS_PER_DURATION) for duration in range(MAX_DURATION + 1)]
+        self._is_rest = (pitch_table.lengths == 0).tolist()
+        self._note_ons = []
+        self._note_offs = []
+
+        for state_id in range(len(pitch_table.lengths)):
+            pitches = [int(p) for p in pitch_table.pitches[state_id, :pitch_table.lengths[state_id]]]
+            # The delta time of the first note-on depends on preceding rests, so it is written separately
+            self._note_ons.append(b''.join((b'' if i == 0 else b'\x00') + bytes([0x90 | channel, p, velocity])
+                                           for i, p in enumerate(pitches)))
+            # Likewise the delta time of the first note-off is the element's duration
+            self._note_offs.append(b'\x00'.join(bytes([0x80 | channel, p, 0]) for p in pitches))
+
+    def write(self, state_ids: np.ndarray, program: int = 0, durations: np.ndarray | None = None) -> bytes:
+        """
+        Render a sequence of state ids as a track chunk.
+        :param state_ids: Sequence of state ids.
+        :param program: General MIDI program set at the start of the track.
+        :param durations: Duration of every element in units of 1 / DURATION_RESOLUTION quarter notes, e.g. from
+                          MusicalMarkovChain.generate_batch(with_durations=True). Every element lasts
+                          ticks_per_element if None.
+        :return: MTrk chunk bytes.
+        """
+        events = bytearray(b'\x00' + bytes([0xC0 | self._channel, program]))
+        pending_delta = 0
+
+        if durations is None:
+            deltas = [self._element_delta] * len(state_ids)
+            rest_ticks = [self._ticks_per_element] * len(state_ids)
+        else:
+            durations = np.clip(durations, 1, MAX_DURATION)
+            deltas = [self._duration_deltas[duration] for duration in durations.tolist()]
+            rest_ticks = (durations * TICKS_PER_DURATION).tolist()
+
+        for state_id, delta, ticks in zip(state_ids.tolist(), deltas, rest_ticks):
+            if self._is_rest[state_id]:
+                pending_delta += ticks
+                continue
+            events += encode_variable_length(pending_delta)
+            events += self._note_ons[state_id]
+            events += delta
+            events += self._note_offs[state_id]
+            pending_delta = 0
+
+        events += encode_variable_length(pending_delta) + b'\xFF\x2F\x00'
+        return track_chunk(bytes(events))
+
+class InterleavedWriter:
+    def __init__(self, pitch_tables: list[PitchTable], channels: list[int], programs: list[int], velocity: int = 80,
+                 ticks_per_element: int = TICKS_PER_QUARTER):
+        """
+        Renders several parts chunk by chunk into one time-ordered stream of MIDI events, for playback while
+        the parts are still being generated. Only the last state of every part is kept between chunks.
+        start(), every write() and close() concatenate to the events of a single track; see track_chunk().
+        :param pitch_tables: Pitches of every state id, one table per part.
+        :param channels: MIDI channel of every part.
+        :param programs: General MIDI program of every part.
+        :param velocity: Note-on velocity.
+        :param ticks_per_element: Duration of every element in ticks.
+        """
+        self._channels = channels
+        self._programs = programs
+        self._ticks_per_element = ticks_per_element
+        self._is_rest = []
+        self._note_ons = []
+        self._note_offs = []
+
+        # Messages without delta times; events sounding at the same tick are joined with zero deltas when written
+        for pitch_table, channel in zip(pitch_tables, channels):
+            self._is_rest.append((pitch_table.lengths == 0).tolist())
+            pitches = [[int(p) for p in pitch_table.pitches[state_id, :pitch_table.lengths[state_id]]]
+                       for state_id in range(len(pitch_table.lengths))]
+            self._note_ons.append([b'\x00'.join(bytes([0x90 | channel, p, velocity]) for p in state_pitches)
+                                   for state_pitches in pitches])
+            self._note_offs.append([b'\x00'.join(bytes([0x80 | channel, p, 0]) for p in state_pitches)
+                                    for state_pitches in pitches])
+
+        self._previous_states = [None] * len(channels)
+        self._pending_delta = 0
+
+    def start(self) -> bytes:
+        """
+        :return: Program change events of all parts, at time 0.
+        """
+        return b''.join(b'\x00' + bytes([0xC0 | channel, program]) for channel, program in zip(self._channels, self._programs))
+
+    def write(self, chunks: list[np.ndarray]) -> bytes:
+        """
+        Render the next chunk of every part. At every step the notes of the previous elements are released
+        before the new ones start, so repeated pitches are re-struck.
+        :param chunks: Next state ids of every part, all of the same length.
+        :return: Event bytes with delta times.
+        """
+        events = bytearray()
+        steps = zip(*(chunk.tolist() for chunk in chunks))
+
+        for states in steps:
+            messages = [self._note_offs[part][previous] for part, previous in enumerate(self._previous_states)
+                        if previous is not None and not self._is_rest[part][previous]]
+            messages += [self._note_ons[part][state] for part, state in enumerate(states) if not self._is_rest[part][state]]
+
+            if messages:
+                events += encode_variable_length(self._pending_delta) + b'\x00'.join(messages)
+                self._pending_delta = 0
+            self._pending_delta += self._ticks_per_element
+            self._previous_states = list(states)
+
+        return bytes(events)
+
+    def close(self) -> bytes:
+        """
+        :return: Note-off events of the last elements followed by the end-of-track event.
+        """
+        messages = [self._note_offs[part][previous] for part, previous in enumerate(self._previous_states)
+                    if previous is not None and not self._is_rest[part][previous]]
+        events = bytearray()
+        if messages:
+            events += encode_variable_length(self._pending_delta) + b'\x00'.join(messages)
+            self._pending_delta = 0
+
+        events += encode_variable_length(self._pending_delta) + b'\xFF\x2F\x00'
+        self._previous_states = [None] * len(self._channels)
+        self._pending_delta = 0
+        return bytes(events)
+
+def track_chunk(events: bytes) -> bytes:
+    """
+    Wrap track events in an MTrk chunk.
+    :param events: Events with delta times, ending with the end-of-track event.
+    :return: MTrk chunk bytes.
+    """
+    return b'MTrk' + len(events).to_bytes(4, 'big') + events
+
+def write_midi_file(tracks: list[bytes], ticks_per_quarter: int = TICKS_PER_QUARTER) -> bytes:
+    """
+    Assemble track chunks into a format 1 Standard MIDI File.
+    :param tracks: MTrk chunks, e.g. from TrackWriter.write().
+    :param ticks_per_quarter: Time division of the file.
+    :return: MIDI file bytes.
+    """
+    header = b'MThd' + (6).to_bytes(4, 'big') + (1).to_bytes(2, 'big') + len(tracks).to_bytes(2, 'big') \
+             + ticks_per_quarter.to_bytes(2, 'big')
+    return header + b''.join(tracks)
@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from typing import Callable, Iterator
+from Instrumentation import count, gauge
+from ModelStore import load_model, read_manifest
+from MusicalMarkovChain import MusicalMarkovChain
+from MusicDataTrainer import MusicDataTrainer
+from Vocabulary import Vocabulary
+
+class ModelRegistry:
+    def __init__(self, instruments: list[str], build_model: Callable[[str], MusicalMarkovChain],
+                 memory_budget: int | None = None, on_evict: Callable[[str], None] | None = None):
+        """
+        Builds or loads per-instrument models on first use and keeps them in an LRU cache, so startup time and
+        memory grow with the instruments actually requested rather than with all instruments of the corpus.
+        :param instruments: Names of all instruments a model can be provided for.
+        :param build_model: Function building or loading the model of an instrument.
+        :param memory_budget: Maximum bytes of cached models (see MusicalMarkovChain.memory_usage()). The least
+                              recently used models are evicted beyond it; the most recent one is always kept.
+                              None caches every model.
+        :param on_evict: Function called with the instrument name of every evicted model, e.g. to drop data derived
+                         from the model along with it.
+        """
+        self._instruments = list(instruments)
+        self._instrument_set = set(self._instruments)
+        self._build_model = build_model
+        self._memory_budget = memory_budget
+        self._on_evict = on_evict
+        self._models = OrderedDict()
+        self._model_bytes = {}
+
+    @classmethod
+    def from_trainer(cls, trainer: MusicDataTrainer, laplace_smoothing: float = 1.0, order: int = 1,
+                     memory_budget: int | None = None, on_evict: Callable[[str], None] | None = None) -> 'ModelRegistry':
+        """
+        Registry normalizing an instrument's counts into a model when it is first requested.
+        :param trainer: Trainer holding the counts.
+        :param laplace_smoothing: Pseudo-count added to every first-order transition.
+        :param order: Markov order of the models, at most the trainer's max_order.
+        :param memory_budget: Maximum bytes of cached models. None caches every model.
+        :param on_evict: Function called with the instrument name of every evicted model.
+        :return: ModelRegistry over the trainer's instruments.
+        """
+        return cls(trainer.instruments,
+                   lambda instr_name: trainer.train_model(instr_name, laplace_smoothing=laplace_smoothing, order=order),
+                   memory_budget=memory_budget, on_evict=on_evict)
+
+    @classmethod
+    def from_directory(cls, model_dir: str, mmap: bool = True, memory_budget: int | None = None,
+                       on_evict: Callable[[str], None] | None = None) -> 'ModelRegistry':
+        """
+        Registry loading an instrument's model from a saved model set when it is first requested.
+        Only the manifest is read up front; all loaded models share one vocabulary.
+        :param model_dir: Directory of a model set saved by ModelStore.save_models().
+        :param mmap: Memory-map the model arrays instead of reading them into memory.
+        :param memory_budget: Maximum bytes of cached models. None caches every model.
+        :param on_evict: Function called with the instrument name of every evicted model.
+        :return: ModelRegistry over the saved instruments.
+        """
+        manifest = read_manifest(model_dir)
+        vocabulary = Vocabulary()
+        return cls(list(manifest['instruments']),
+                   lambda instr_name: load_model(model_dir, instr_name, mmap=mmap, vocabulary=vocabulary, manifest=manifest),
+                   memory_budget=memory_budget, on_evict=on_evict)
+
+    @property
+    def instruments(self) -> list[str]:
+        return list(self._instruments)
+
+    @property
+    def cached_instruments(self) -> list[str]:
+        """
+        Instruments whose models are currently cached, least recently used first.
+        """
+        return list(self._models)
+
+    @property
+    def memory_usage(self) -> int:
+        """
+        Bytes held by the cached models.
+        """
+        return sum(self._model_bytes.values())
+
+    def __len__(self) -> int:
+        return len(self._instruments)
+
+    def __contains__(self, instr_name: str) -> bool:
+        return instr_name in self._instrument_set
+
+    def __getitem__(self, instr_name: str) -> MusicalMarkovChain:
+        """
+        Get the model of an instrument, building or loading it if it is not cached.
+        :param instr_name: Instrument name.
+        :return: Model of the instrument.
+        :raises KeyError: If the registry has no such instrument.
+        """
+        model = self._models.get(instr_name)
+        if model is not None:
+            self._models.move_to_end(instr_name)
+            count('model_cache_hits')
+            return model
+
+        if instr_name not in self._instrument_set:
+            raise KeyError(instr_name)
+
+        count('model_cache_misses')
+        model = self._build_model(instr_name)
+        self._models[instr_name] = model
+        self._model_bytes[instr_name] = sum(model.memory_usage().values())
+        self._evict()
+        return model
+
+    def _evict(self) -> None:
+        """
+        Drop least recently used models until the cache fits the memory budget, keeping the most recent one.
+        """
+        if self._memory_budget is not None:
+            while len(self._models) > 1 and self.memory_usage > self._memory_budget:
+                instr_name, _ = self._models.popitem(last=False)
+                del self._model_bytes[instr_name]
+                count('model_cache_evictions')
+                if self._on_evict is not None:
+                    self._on_evict(instr_name)
+        gauge('model_cache_bytes', self.memory_usage)
+
+    def items(self) -> Iterator[tuple[str, MusicalMarkovChain]]:
+        """
+        Iterate over all instruments and their models, building them one at a time. Models beyond the memory
+        budget are evicted again as the iteration goes on, e.g. while saving them with save_models().
+        :return: Iterator of (instrument name, model) tuples.
+        """
+        for instr_name in self._instruments:
+            yield instr_name, self[instr_name]
@@ -0,0 +1,84 @@
+import os
+import json
+from MusicalMarkovChain import MusicalMarkovChain
+from Vocabulary import Vocabulary
+
+# Bump whenever the on-disk layout of saved models changes
+MODEL_FORMAT_VERSION = 4
+
+# Version 1 models are first-order models without context indices; versions 1 and 2 store states as strings;
+# models before version 4 have no duration chain
+SUPPORTED_FORMAT_VERSIONS = (1, 2, 3, 4)
+
+def save_models(models, model_dir: str) -> None:
+    """
+    Save per-instrument models to a directory. Every model gets its own numbered subdirectory,
+    and manifest.json maps instrument names to them.
+    :param models: Dictionary mapping instrument names to trained models, or a ModelRegistry (models are then
+                   built one at a time while saving).
+    :param model_dir: Directory to save the models to. Created if missing.
+    :return: None
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    instruments = {}
+
+    for index, (instr_name, model) in enumerate(models.items()):
+        subdirectory = f'{index:04d}'
+        model.save(os.path.join(model_dir, subdirectory))
+        instruments[instr_name] = subdirectory
+
+    # Written last, so a directory with a manifest always holds a complete model set
+    with open(os.path.join(model_dir, 'manifest.json'), 'w') as f:
+        json.dump({'format_version': MODEL_FORMAT_VERSION, 'instruments': instruments}, f, indent=2)
+
+def read_manifest(model_dir: str) -> dict:
+    """
+    Read the manifest of a model set saved by save_models().
+    :param model_dir: Directory containing manifest.json and the model subdirectories.
+    :return: Manifest dict with 'format_version' and 'instruments' (instrument name to subdirectory).
+    :raises ValueError: If the models were saved in an unsupported format version.
+    """
+    with open(os.path.join(model_dir, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+
+    if manifest['format_version'] not in SUPPORTED_FORMAT_VERSIONS:
+        raise ValueError(f"Unsupported model format version {manifest['format_version']}, expected one of {SUPPORTED_FORMAT_VERSIONS}")
+
+    return manifest
+
+def load_model(model_dir: str, instr_name: str, mmap: bool = True, vocabulary: Vocabulary | None = None,
+               manifest: dict | None = None) -> MusicalMarkovChain:
+    """
+    Load the model of a single instrument from a model set saved by save_models().
+    :param model_dir: Directory containing manifest.json and the model subdirectories.
+    :param instr_name: Instrument name.
+    :param mmap: Memory-map the model arrays instead of reading them into memory.
+    :param vocabulary: Vocabulary to intern the model's states into. A new one if None.
+    :param manifest: Manifest from read_manifest(), to avoid reading it again.
+    :return: Loaded model.
+    :raises KeyError: If the model set has no model for the instrument.
+    """
+    manifest = manifest if manifest is not None else read_manifest(model_dir)
+    return MusicalMarkovChain.load(os.path.join(model_dir, manifest['instruments'][instr_name]), mmap=mmap,
+                                   vocabulary=vocabulary)
+
+def load_models(model_dir: str, mmap: bool = True) -> dict[str, MusicalMarkovChain]:
+    """
+    Load per-instrument models saved by save_models(). All models share one vocabulary.
+    :param model_dir: Directory containing manifest.json and the model subdirectories.
+    :param mmap: Memory-map the model arrays instead of reading them into memory.
+    :return: Dictionary mapping instrument names to loaded models.
+    :raises ValueError: If the models were saved in an unsupported format version.
+    """
+    manifest = read_manifest(model_dir)
+    vocabulary = Vocabulary()
+    return {instr_name: load_model(model_dir, instr_name, mmap=mmap, vocabulary=vocabulary, manifest=manifest)
+            for instr_name in manifest['instruments']}
+
+def has_models(model_dir: str) -> bool:
+    """
+    Check whether a directory contains a saved model set.
+    :param model_dir: Directory to check.
+    :return: True if save_models() completed in the directory.
+    """
+    return os.path.isfile(os.path.join(model_dir, 'manifest.json'))
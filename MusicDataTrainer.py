@@ -1,164 +1,463 @@
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Iterator
 import music21
-import pandas as pd
+import numpy as np
+from ConstraintIndex import ConstraintIndex
+from Instrumentation import count, gauge, record_stage, stage
+from MidiTokenizer import MIDI_TOKENIZER_VERSION, iter_midi_tokens
 from MusicalMarkovChain import MusicalMarkovChain
+from ShardStore import iter_shard_counts, load_shard_vocabulary, read_shard_manifest, save_shard
+from TokenCache import TokenCache
+from TransitionCounts import TransitionCounts
+from Vocabulary import REST_MASK, Vocabulary, masks_to_array, pitches_to_mask, quarter_lengths_to_durations
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+
+# Bump whenever _get_music_elements changes the tokens it produces, so stale cache entries are ignored
+TOKENIZER_VERSION = '3'
+
+# 'music21' builds full music21 streams, 'midi' reads the MIDI chunks directly (see MidiTokenizer)
+TOKENIZERS = {'music21': TOKENIZER_VERSION, 'midi': MIDI_TOKENIZER_VERSION}
+
+def find_midi_files(data_path: str) -> list[str]:
+    """
+    Recursively collect the paths of all MIDI files under a directory.
+    :param data_path: Path to the directory containing MIDI files.
+    :return: Sorted list of MIDI file paths.
+    """
+    midi_paths = []
+
+    for root, dirs, files in os.walk(data_path):
+        for filename in files:
+            if filename.lower().endswith(MIDI_EXTENSIONS):
+                midi_paths.append(os.path.join(root, filename))
+
+    return sorted(midi_paths)
+
+def _extract_parts(midi_path: str, tokenizer: str = 'music21') -> tuple[str, list[tuple[str, np.ndarray, np.ndarray]] | None, str | None, dict[str, float]]:
+    """
+    Parse a single MIDI file, partition it by instruments and tokenize every part.
+    Runs inside pool workers, so only the compact pitch-set masks and durations are sent back to the parent,
+    which interns them.
+    :param midi_path: Path to the MIDI file.
+    :param tokenizer: Name of the tokenizer to use, one of TOKENIZERS.
+    :return: Tuple of (midi_path, list of (instrument name, pitch-set masks, durations) or None, error message or None,
+             seconds spent in every step), the timings being reported by the parent when instrumentation is enabled.
+    """
+    timings = {}
+    start = time.perf_counter()
+    try:
+        if tokenizer == 'midi':
+            parts = list(iter_midi_tokens(midi_path))
+        else:
+            score = music21.converter.parse(midi_path)
+            timings['parse'] = time.perf_counter() - start
+            partitioned_score = music21.instrument.partitionByInstrument(score)
+            timings['partition'] = time.perf_counter() - start - timings['parse']
+            start = time.perf_counter()
+            parts = [(part.getInstrument().instrumentName, *MusicDataTrainer._get_music_elements(part))
+                     for part in partitioned_score.parts]
+    except Exception as e:
+        return midi_path, None, f'{type(e).__name__}: {e}', timings
+    timings['tokenize'] = time.perf_counter() - start
+
+    return midi_path, parts, None, timings
 
 class MusicDataTrainer:
-    def __init__(self, data_path: str = 'MIDI_files'):
+    def __init__(self, data_path: str = 'MIDI_files', n_workers: int | None = 1, chunk_size: int = 16,
+                 cache_dir: str | None = None, tokenizer: str = 'music21', max_order: int = 1,
+                 midi_paths: list[str] | None = None, track_files: bool = False):
+        """
+        :param data_path: Path to the directory containing MIDI files.
+        :param n_workers: Number of worker processes used for parsing. 1 parses serially, None uses all CPUs.
+        :param chunk_size: Number of files parsed ahead per worker in parallel mode. Bounds the tokens held in memory.
+        :param cache_dir: Directory of the on-disk token cache. Unchanged files are loaded from it instead of being reparsed. None disables caching.
+        :param tokenizer: 'music21' to tokenize music21 streams, or 'midi' to use the faster direct MIDI tokenizer.
+        :param max_order: Highest Markov order analyze_data() can build models of. Higher orders cost counting time and memory.
+        :param midi_paths: MIDI files to train on instead of all files under data_path, e.g. one shard of the corpus
+                           (see save_counts()). An empty list starts without data, e.g. to merge_counts() only.
+        :param track_files: Keep the counts of every added file and merged shard, so remove() can take them out again
+                            and update() can replace files added before. They grow with the corpus, about as large as
+                            its tokens at order 1 and several times larger at higher orders.
+        """
+        if tokenizer not in TOKENIZERS:
+            raise ValueError(f"Unknown tokenizer '{tokenizer}', expected one of {list(TOKENIZERS)}")
+
         self._data_path = data_path
+        self._n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self._chunk_size = chunk_size
+        self._tokenizer = tokenizer
+        self._cache = TokenCache(cache_dir, f'{tokenizer}-{TOKENIZERS[tokenizer]}') if cache_dir is not None else None
+        self._max_order = max_order
+        self._laplace_smoothing = 1.0
+        self._order = 1
+        self._counts = {}
+        self._duration_counts = {}
+        self._track_files = track_files
+        self._sources = {}
+        self._contributions = {}
+        self._dirty_instruments = set()
+        self.vocabulary = Vocabulary()
+        self._states = {}
         self._transition_matrices = {}
         self._starting_probabilities = {}
-        self._scores = self._load_data()
-        self.instrument_mapping = self._get_all_instruments()
+        self._context_indices = {}
+        self._duration_chains = {}
+        self._constraint_indices = {}
+        self.instrument_mapping = {}
+        self.update(midi_paths if midi_paths is not None else find_midi_files(data_path))
         
-    def _load_data(self) -> list[music21.stream.Score]:
-        """
-        Parse MIDI files from the given directory and partition them by instruments.
-        :param input_path: Path to the directory containing MIDI files.
-        :return: List of partitioned music21 Score objects.
-        """
-        scores = []
-
-        for root, dirs, files in os.walk(self._data_path):
-            for filename in files:
-                if filename.lower().endswith('.mid') or filename.lower().endswith('.midi'):
-                    midi_path = os.path.join(root, filename)
-                    score = music21.converter.parse(midi_path)
-                    partitioned_score = music21.instrument.partitionByInstrument(score)
-                    scores.append(partitioned_score)
-                
-        return scores
-    
-    def _get_all_instruments(self) -> dict[str, int]:
-        """
-        Get a mapping of all unique instruments from the parsed scores to their indices.
-        :return: Dict of instrument names mapped to their indices.
-        """
-        instrument_mapping = dict()
-        index = 0
-
-        for score in self._scores:
-            for part in score.parts:
-                instr = part.getInstrument()
-                if instr.instrumentName not in instrument_mapping:
-                    instrument_mapping[instr.instrumentName] = index
-                    index += 1
-
-        return instrument_mapping
-    
-    def _get_music_elements(self, part: music21.stream.Part) -> list[str]:
-        """
-        Extract music elements (notes, chords, rests) from a music21 Part object.
+    def _load_data(self, midi_paths: list[str]) -> Iterator[tuple[str, list[tuple[str, np.ndarray, np.ndarray]]]]:
+        """
+        Parse MIDI files, partition them by instruments and tokenize every part, streaming the files one by one.
+        Every file is yielded as soon as it is tokenized, and its music21 objects never leave the worker, so the
+        caller can count it and drop it. In parallel mode at most n_workers * chunk_size files are parsed ahead,
+        so the tokens held at once are bounded by the files in flight rather than by the corpus. The merged counts
+        still grow with the corpus.
+        Files found in the token cache are not parsed again. Files that fail to parse are reported and skipped.
+        :param midi_paths: Paths of the MIDI files to load.
+        :return: Iterator of (midi_path, list of (instrument name, pitch-set masks, durations)) tuples, in the order of midi_paths.
+        """
+        extract_parts = partial(_extract_parts, tokenizer=self._tokenizer)
+        parallel = self._n_workers > 1 and len(midi_paths) > 1
+        max_in_flight = self._n_workers * self._chunk_size if parallel else 1
+
+        executor = ProcessPoolExecutor(max_workers=self._n_workers) if parallel else None
+        # Every pending file holds its cached parts, the future of its parse, or None if it is parsed when its turn comes
+        pending = deque()
+        remaining_paths = iter(midi_paths)
+
+        try:
+            while True:
+                for midi_path in islice(remaining_paths, max_in_flight - len(pending)):
+                    cached_parts = self._cache.get(midi_path) if self._cache is not None else None
+                    if cached_parts is not None:
+                        count('cache_hits')
+                        pending.append((midi_path, cached_parts))
+                    else:
+                        pending.append((midi_path, executor.submit(extract_parts, midi_path) if parallel else None))
+                if not pending:
+                    break
+
+                midi_path, item = pending.popleft()
+                if isinstance(item, list):
+                    yield midi_path, item
+                    continue
+
+                _, parts, error, timings = item.result() if item is not None else extract_parts(midi_path)
+                count('files_parsed')
+                for step, seconds in timings.items():
+                    record_stage(step, seconds, tokenizer=self._tokenizer)
+                if error is not None:
+                    print(f'Skipping file {midi_path}: {error}')
+                    count('files_failed')
+                    continue
+                if self._cache is not None:
+                    self._cache.put(midi_path, parts)
+                yield midi_path, parts
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    def _add_instruments(self, parts: list[tuple[str, np.ndarray, np.ndarray]]) -> None:
+        """
+        Add instruments not seen before to the mapping of instrument names to their indices.
+        :param parts: List of (instrument name, pitch-set masks, durations) tuples.
+        :return: None
+        """
+        for instr_name, _, _ in parts:
+            if instr_name not in self.instrument_mapping:
+                self.instrument_mapping[instr_name] = len(self.instrument_mapping)
+
+    def update(self, midi_paths: list[str]) -> None:
+        """
+        Add MIDI files to the training data. Only these files are tokenized; their transition counts are merged
+        into the existing counts file by file, and their tokens are dropped right after. With track_files, files added
+        before are replaced by their current contents.
+        The models are renormalized on the next analyze_data() or train_models() call.
+        :param midi_paths: Paths of the MIDI files to add.
+        :return: None
+        :raises ValueError: If a file was added before and track_files is off.
+        """
+        self.remove([midi_path for midi_path in midi_paths if midi_path in self._sources])
+
+        # Loading and counting are interleaved, so only the counting time is summed up separately
+        count_seconds = 0.0
+        with stage('load_data', tokenizer=self._tokenizer):
+            for midi_path, parts in self._load_data(midi_paths):
+                start = time.perf_counter()
+                self._add_file(midi_path, parts)
+                count_seconds += time.perf_counter() - start
+        record_stage('count', count_seconds)
+
+    def _add_file(self, midi_path: str, parts: list[tuple[str, np.ndarray, np.ndarray]]) -> None:
+        """
+        Intern the tokens of one file, merge its pitch and duration transition counts and, with track_files, remember
+        its contribution for remove().
+        :param midi_path: Path of the MIDI file.
+        :param parts: List of (instrument name, pitch-set masks, durations) tuples of the file.
+        :return: None
+        """
+        self._add_instruments(parts)
+        parts_by_instrument = {}
+        durations_by_instrument = {}
+
+        # Only parts with at least one transition contribute
+        for instr_name, masks, durations in parts:
+            if len(masks) >= 2:
+                parts_by_instrument.setdefault(instr_name, []).append(self.vocabulary.intern_masks(masks))
+                durations_by_instrument.setdefault(instr_name, []).append(durations)
+                count('parts', instrument=instr_name)
+                count('tokens', len(masks), instrument=instr_name)
+        count('files')
+
+        contributions = []
+        for instr_name, instr_parts in parts_by_instrument.items():
+            if instr_name not in self._counts:
+                self._counts[instr_name] = TransitionCounts(self.vocabulary, max_order=self._max_order)
+                # Durations are plain integers and form their own first-order chain
+                self._duration_counts[instr_name] = TransitionCounts(None)
+            contribution = self._counts[instr_name].count(instr_parts)
+            self._counts[instr_name].add(contribution)
+            duration_contribution = self._duration_counts[instr_name].count(durations_by_instrument[instr_name])
+            self._duration_counts[instr_name].add(duration_contribution)
+            contributions.append((instr_name, contribution, duration_contribution))
+            self._dirty_instruments.add(instr_name)
+
+        self._sources[midi_path] = None
+        if self._track_files:
+            self._contributions[midi_path] = contributions
+
+    def remove(self, midi_paths: list[str]) -> None:
+        """
+        Remove the contribution of previously added MIDI files from the transition counts.
+        The files do not need to exist anymore. Instruments stay in instrument_mapping.
+        :param midi_paths: Paths of the MIDI files (or shard directories, see merge_counts()) to remove. Paths that were never added are ignored.
+        :return: None
+        :raises ValueError: If a path was added but track_files is off, so its counts were not kept.
+        """
+        if not self._track_files:
+            added_paths = [midi_path for midi_path in midi_paths if midi_path in self._sources]
+            if added_paths:
+                raise ValueError(f'Cannot remove or replace {added_paths}: per-file counts are only kept with track_files=True')
+
+        for midi_path in midi_paths:
+            if midi_path in self._sources:
+                del self._sources[midi_path]
+                count('files_removed')
+            for instr_name, contribution, duration_contribution in self._contributions.pop(midi_path, []):
+                self._counts[instr_name].subtract(contribution)
+                self._duration_counts[instr_name].subtract(duration_contribution)
+                self._dirty_instruments.add(instr_name)
+
+    def save_counts(self, shard_dir: str) -> None:
+        """
+        Save the raw counts as a shard, the map step of sharded training: every process or machine counts its own
+        part of the corpus, e.g. MusicDataTrainer(midi_paths=shard) with a shard from ShardStore.split_shards(),
+        and saves the counts; merge_counts() then reduces the shards into one trainer.
+        Only counts are saved, so a shard is small compared to its MIDI files and holds no parsed scores.
+        :param shard_dir: Directory to save the shard to.
+        :return: None
+        """
+        with stage('save_counts'):
+            manifest = {'tokenizer': f'{self._tokenizer}-{TOKENIZERS[self._tokenizer]}', 'max_order': self._max_order,
+                        'sources': list(self._sources)}
+            counts = {instr_name: (self._counts[instr_name].to_arrays(), self._duration_counts[instr_name].to_arrays())
+                      for instr_name in self._counts}
+            save_shard(shard_dir, manifest, self.vocabulary.masks, counts)
+
+    def merge_counts(self, shard_dirs: list[str]) -> None:
+        """
+        Merge the counts of shards saved by save_counts(), the reduce step of sharded training. Shard token ids are
+        mapped to this trainer's vocabulary by their pitch sets, and models are built from the summed counts
+        ordered by pitch set, so they do not depend on how the corpus was split or in which order shards are merged.
+        A shard is merged like a file: with track_files, merging it again replaces it, and remove([shard_dir]) takes it out again.
+        :param shard_dirs: Directories of the shards.
+        :return: None
+        :raises ValueError: If a shard was counted with another tokenizer or a lower max_order, or was merged before
+                            and track_files is off.
+        """
+        tokenizer = f'{self._tokenizer}-{TOKENIZERS[self._tokenizer]}'
+
+        with stage('merge_counts'):
+            for shard_dir in shard_dirs:
+                manifest = read_shard_manifest(shard_dir)
+                if manifest['tokenizer'] != tokenizer:
+                    raise ValueError(f"Shard {shard_dir} was counted with tokenizer {manifest['tokenizer']}, expected {tokenizer}")
+                if manifest['max_order'] < self._max_order:
+                    raise ValueError(f"Shard {shard_dir} only counts orders up to {manifest['max_order']}, "
+                                     f"but the trainer needs {self._max_order}")
+
+                self.remove([shard_dir])
+                id_map = self.vocabulary.intern_masks(load_shard_vocabulary(shard_dir))
+
+                contributions = []
+                for instr_name, arrays, duration_arrays in iter_shard_counts(shard_dir, manifest):
+                    if instr_name not in self.instrument_mapping:
+                        self.instrument_mapping[instr_name] = len(self.instrument_mapping)
+                    if instr_name not in self._counts:
+                        self._counts[instr_name] = TransitionCounts(self.vocabulary, max_order=self._max_order)
+                        self._duration_counts[instr_name] = TransitionCounts(None)
+
+                    contribution = TransitionCounts.contribution_from_arrays(arrays, self._max_order, id_map)
+                    self._counts[instr_name].add(contribution)
+                    duration_contribution = TransitionCounts.contribution_from_arrays(duration_arrays)
+                    self._duration_counts[instr_name].add(duration_contribution)
+                    contributions.append((instr_name, contribution, duration_contribution))
+                    self._dirty_instruments.add(instr_name)
+
+                self._sources[shard_dir] = None
+                if self._track_files:
+                    self._contributions[shard_dir] = contributions
+                count('shards_merged')
+
+    @property
+    def instruments(self) -> list[str]:
+        """
+        Instruments with at least one counted transition, i.e. those a model can be built for.
+        """
+        return [instr_name for instr_name, counts in self._counts.items() if counts.n_transitions > 0]
+
+    def train_model(self, instr_name: str, laplace_smoothing: float = 1.0, order: int = 1) -> MusicalMarkovChain:
+        """
+        Build the model of a single instrument straight from its counts, without touching the parameters
+        kept by analyze_data(). Used to build models lazily, only for the instruments actually needed.
+        :param instr_name: Instrument name.
+        :param laplace_smoothing: Pseudo-count added to every first-order transition.
+        :param order: Markov order of the model, at most the trainer's max_order.
+        :return: Trained MusicalMarkovChain.
+        :raises KeyError: If the instrument has no transitions.
+        """
+        counts = self._counts.get(instr_name)
+        if counts is None or counts.n_transitions == 0:
+            raise KeyError(f'No transitions counted for instrument {instr_name}')
+
+        with stage('normalize', instrument=instr_name):
+            states, transition_matrix, starting_probabilities, context_indices = counts.normalize(laplace_smoothing, order)
+            duration_chain = self._build_duration_chain(instr_name, laplace_smoothing)
+        with stage('constraint_index', instrument=instr_name):
+            constraint_index = ConstraintIndex(self.vocabulary.masks[states], transition_matrix)
+        with stage('train_model', instrument=instr_name):
+            return MusicalMarkovChain(self.vocabulary, states, transition_matrix, starting_probabilities,
+                                      context_indices=context_indices, duration_chain=duration_chain,
+                                      constraint_index=constraint_index)
+
+    def _build_duration_chain(self, instr_name: str, laplace_smoothing: float) -> MusicalMarkovChain:
+        """
+        Normalize the duration counts of an instrument into a first-order chain over its durations.
+        :param instr_name: Instrument name.
+        :param laplace_smoothing: Pseudo-count added to every duration transition.
+        :return: MusicalMarkovChain whose states are durations (see Vocabulary.DURATION_RESOLUTION).
+        """
+        states, transition_matrix, starting_probabilities, _ = self._duration_counts[instr_name].normalize(laplace_smoothing)
+        return MusicalMarkovChain(None, states, transition_matrix, starting_probabilities)
+
+    @staticmethod
+    def _get_music_elements(part: music21.stream.Part) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Extract music elements (notes, chords, rests) and their durations from a music21 Part object.
         :param part: music21 Part object.
-        :return: List of music elements represented as tuples of MIDI numbers.
+        :return: Tuple of (array of shape (n, 2) of the pitch-set masks of the music elements, array of their
+                 n durations), see Vocabulary.
         """
         music_elements = []
+        quarter_lengths = []
 
         for element in part.recurse():
             if isinstance(element, music21.note.Note):
-                music_elements.append(str(element.pitch.midi))
+                music_elements.append(1 << element.pitch.midi)
             elif isinstance(element, music21.chord.Chord):
-                chord_tuple = ','.join(str(p.midi) for p in sorted(element.pitches, key=lambda p: p.midi))
-                music_elements.append(chord_tuple)
+                music_elements.append(pitches_to_mask(p.midi for p in element.pitches))
             elif isinstance(element, music21.note.Rest):
-                music_elements.append(str(-1))
+                music_elements.append(REST_MASK)
+            else:
+                continue
+            quarter_lengths.append(float(element.duration.quarterLength))
 
-        return music_elements
+        return masks_to_array(music_elements), quarter_lengths_to_durations(quarter_lengths)
 
-    def analyze_data(self, laplace_smoothing: float = 1.0) -> None:
+    def analyze_data(self, laplace_smoothing: float = 1.0, order: int = 1) -> None:
         """
-        Creates parameters needed for a Markov Chain probabilistic model - transition matrices and starting probabilities.
+        Creates parameters needed for a Markov Chain probabilistic model - transition matrices and starting probabilities,
+        and a first-order chain over the durations of every instrument. A ConstraintIndex of every instrument's states
+        (pitch classes, key compatibility, observed successors) is built as well, for constrained generation.
+        They are normalized from the raw transition counts, with Laplace smoothing applied implicitly instead of being
+        added to every cell. Only instruments whose counts changed since the last call are rebuilt.
+        For order > 1, context indices of orders 2..order are built as well (see ContextIndex).
         The models are NOT trained yet after running this method. For training, call the train_models() method.
+        :param laplace_smoothing: Pseudo-count added to every first-order transition.
+        :param order: Markov order of the models, at most the trainer's max_order.
         :return: None
         """
-        transitions_by_instrument = {}
-        initial_notes_by_instrument = {}
+        if order > self._max_order:
+            raise ValueError(f'Order {order} requested, but the trainer only counts orders up to {self._max_order}')
 
-        # Find all transitions for each instrument
-        for score in self._scores:
-            for part in score.parts:
-                instr = part.getInstrument()
-                instr_name = instr.instrumentName
+        if laplace_smoothing != self._laplace_smoothing or order != self._order:
+            self._laplace_smoothing = laplace_smoothing
+            self._order = order
+            self._dirty_instruments.update(self._counts.keys())
 
-                music_elements = self._get_music_elements(part)
+        with stage('analyze_data', order=order):
+            for instr_name in self._dirty_instruments:
+                counts = self._counts[instr_name]
 
-                if len(music_elements) < 2:
+                # Remove instruments with no transitions
+                if counts.n_transitions == 0:
+                    self._states.pop(instr_name, None)
+                    self._transition_matrices.pop(instr_name, None)
+                    self._starting_probabilities.pop(instr_name, None)
+                    self._context_indices.pop(instr_name, None)
+                    self._duration_chains.pop(instr_name, None)
+                    self._constraint_indices.pop(instr_name, None)
                     continue
-                
-                # Append initial notes (starting probabilities) for each instrument
-                if instr_name not in initial_notes_by_instrument:
-                    initial_notes_by_instrument[instr_name] = [music_elements[0]]
-                else:
-                    initial_notes_by_instrument[instr_name].append(music_elements[0])
-
-                # Pairs of (current_note, next_note)
-                transition_pairs = list(zip(music_elements[:-1], music_elements[1:]))
-
-                if instr_name not in transitions_by_instrument:
-                    transitions_by_instrument[instr_name] = transition_pairs
-                else:
-                    transitions_by_instrument[instr_name].extend(transition_pairs)
-        
-        # Remove instruments with no transitions
-        keys_to_remove = [k for k, v in transitions_by_instrument.items() if len(v) == 0]
-
-        for k in keys_to_remove:
-            transitions_by_instrument.pop(k, None)
-            initial_notes_by_instrument.pop(k, None)
-        
-        # Build transition matrices for each instrument
-        for instr_name, transitions in transitions_by_instrument.items():
-
-            current_notes, next_notes = zip(*transitions)
 
-            current_notes_series = pd.Series(current_notes, name='current')
-            next_notes_series = pd.Series(next_notes, name='next')
+                with stage('normalize', instrument=instr_name):
+                    states, transition_matrix, starting_probabilities, context_indices = counts.normalize(laplace_smoothing, order)
+                self._states[instr_name] = states
+                self._transition_matrices[instr_name] = transition_matrix
+                self._starting_probabilities[instr_name] = starting_probabilities
+                self._context_indices[instr_name] = context_indices
+                with stage('normalize_durations', instrument=instr_name):
+                    self._duration_chains[instr_name] = self._build_duration_chain(instr_name, laplace_smoothing)
+                with stage('constraint_index', instrument=instr_name):
+                    self._constraint_indices[instr_name] = ConstraintIndex(self.vocabulary.masks[states], transition_matrix)
 
-            counts = pd.crosstab(current_notes_series, next_notes_series)
+                gauge('states', len(states), instrument=instr_name)
+                gauge('transitions', counts.n_transitions, instrument=instr_name)
+                gauge('matrix_nnz', transition_matrix.nnz, instrument=instr_name)
+                for context_index in context_indices:
+                    gauge('contexts', len(context_index.keys), instrument=instr_name, order=context_index.order)
 
-            all_notes = sorted(list(set(current_notes) | set(next_notes)))
-            squared_counts = counts.reindex(index=all_notes, columns=all_notes, fill_value=0)
-
-            # Apply Laplace smoothing
-            if laplace_smoothing > 0:
-                squared_counts += laplace_smoothing
-            
-            # Normalize rows to get probabilities
-            squared_counts = squared_counts.div(squared_counts.sum(axis=1), axis=0)
-
-            self._transition_matrices[instr_name] = squared_counts
-        
-        # Build starting probabilities for each instrument
-        for instr_name, initial_notes in initial_notes_by_instrument.items():
-            initial_notes_series = pd.Series(initial_notes, name='initial').value_counts()
-            initial_counts = initial_notes_series.reindex(self._transition_matrices[instr_name].index, fill_value=0)
-
-            self._starting_probabilities[instr_name] = initial_counts / initial_counts.sum()
+        self._dirty_instruments.clear()
 
     def train_models(self) -> dict[str, MusicalMarkovChain]:
         """
         Train the Markov Chain models using the extracted parameters from analyze_data().
+        Counts changed by update() or remove() since then are renormalized first.
         :return: Dictionary mapping instrument names to their trained MusicalMarkovChain models.
         :rtype: dict[str, MusicalMarkovChain]
         """
         models = {}
 
-        for instr_name in self._transition_matrices.keys():
-            transition_matrix = self._transition_matrices[instr_name]
-            starting_probabilities = self._starting_probabilities[instr_name]
+        if self._dirty_instruments:
+            self.analyze_data(self._laplace_smoothing, self._order)
+
+        with stage('train_models'):
+            for instr_name in self._transition_matrices.keys():
+                states = self._states[instr_name]
+                transition_matrix = self._transition_matrices[instr_name]
+                starting_probabilities = self._starting_probabilities[instr_name]
+
+                markov_chain = MusicalMarkovChain(self.vocabulary, states, transition_matrix, starting_probabilities,
+                                                  context_indices=self._context_indices[instr_name],
+                                                  duration_chain=self._duration_chains[instr_name],
+                                                  constraint_index=self._constraint_indices[instr_name])
+                models[instr_name] = markov_chain
+        gauge('vocabulary_size', len(self.vocabulary))
 
-            markov_chain = MusicalMarkovChain(transition_matrix, starting_probabilities)
-            models[instr_name] = markov_chain
-        
         return models
-    
-    @staticmethod
-    def str_to_midi_tuple(music_element: str) -> tuple[int, ...]:
-        """
-        Convert a string of MIDI numbers to a tuple representation.
-        :param music_element: String representation of the MIDI tuple.
-        :return: Tuple of MIDI numbers.
-        """
-        tokens = music_element.split(',')
-        midi_tuple = tuple(int(midi_str) for midi_str in tokens)
-        return midi_tuple
\ No newline at end of file
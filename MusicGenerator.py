@@ -1,49 +1,370 @@
+import os
 import music21
 import numpy as np
+from typing import Iterator
+from Instrumentation import count, stage
+from MidiWriter import PITCHED_CHANNELS, InterleavedWriter, PitchTable, TrackWriter, write_midi_file
+from MusicalMarkovChain import Seed, spawn_generators
 from MusicDataTrainer import MusicDataTrainer
+from ModelRegistry import ModelRegistry
+from ModelStore import has_models, save_models
+from Vocabulary import DURATION_RESOLUTION, Vocabulary, pitches_to_mask
+
+# Constraints of an unconstrained generate_music() call
+_NO_CONSTRAINTS = {'key': None, 'avoid_pitches': None, 'end_pitch_classes': None, 'phrases': None}
 
 class MusicGenerator:
-    def __init__(self, data_path: str = 'MIDI_files', laplace_smoothing: float = 1.0):
-        self._data_trainer = MusicDataTrainer(data_path=data_path)
-        self._data_trainer.analyze_data(laplace_smoothing=laplace_smoothing)
-        self._models_by_instrument = self._data_trainer.train_models()
+    def __init__(self, data_path: str = 'MIDI_files', laplace_smoothing: float = 1.0, n_workers: int | None = 1,
+                 cache_dir: str | None = None, model_path: str | None = None, tokenizer: str = 'music21',
+                 order: int = 1, memory_budget: int | None = None):
+        """
+        Models are built (or loaded) lazily, the first time an instrument is used, and kept in a ModelRegistry.
+        :param model_path: Directory of saved models. If it holds a model set, its models are memory-mapped on first use
+                           instead of training; otherwise all freshly trained models are saved there.
+        :param order: Markov order of the trained models.
+        :param memory_budget: Maximum bytes of models kept at once; least recently used ones are rebuilt when needed again,
+                              and their pitch tables and track writers are dropped with them. None keeps every model that was used.
+        """
+        self._pitch_tables = {}
+        self._track_writers = {}
+
+        if model_path is not None and has_models(model_path):
+            self._data_trainer = None
+            self._models_by_instrument = ModelRegistry.from_directory(model_path, memory_budget=memory_budget,
+                                                                      on_evict=self._drop_render_caches)
+            return
+
+        self._data_trainer = MusicDataTrainer(data_path=data_path, n_workers=n_workers, cache_dir=cache_dir,
+                                              tokenizer=tokenizer, max_order=order)
+        self._models_by_instrument = ModelRegistry.from_trainer(self._data_trainer, laplace_smoothing=laplace_smoothing,
+                                                                order=order, memory_budget=memory_budget,
+                                                                on_evict=self._drop_render_caches)
+
+        if model_path is not None:
+            with stage('save_models'):
+                save_models(self._models_by_instrument, model_path)
+
+    @staticmethod
+    def _build_part(generated_sequence: np.ndarray, vocabulary: Vocabulary,
+                    music21_instr: music21.instrument.Instrument, durations: np.ndarray | None = None) -> music21.stream.Part:
+        """
+        Build a music21 Part from a generated sequence of music elements.
+        :param generated_sequence: Sequence of token ids.
+        :param vocabulary: Vocabulary of the token ids.
+        :param music21_instr: Instrument stored on the notes and chords of the part.
+        :param durations: Duration of every element in units of 1 / DURATION_RESOLUTION quarter notes.
+                          Every element is a quarter note if None.
+        :return: music21 Part with measures.
+        """
+        part = music21.stream.Part()
+        quarter_lengths = (durations / DURATION_RESOLUTION).tolist() if durations is not None else [1.0] * len(generated_sequence)
+        for token_id, quarter_length in zip(generated_sequence.tolist(), quarter_lengths):
+            music_element = vocabulary.pitches(token_id)
+            if len(music_element) > 1:
+                c = music21.chord.Chord()
+                for midi_pitch in music_element:
+                    n = music21.note.Note(midi=midi_pitch)
+                    c.add(n)
+                c.storedInstrument = music21_instr
+                c.quarterLength = quarter_length
+                part.append(c)
+                continue
+            elif len(music_element) == 0:
+                r = music21.note.Rest(quarterLength=quarter_length)
+                part.append(r)
+                continue
+            else:
+                note = music21.note.Note(midi=music_element[0], quarterLength=quarter_length)
+                note.storedInstrument = music21_instr
+                part.append(note)
+        part.makeMeasures()
+        return part
+
+    def _get_instrument(self, instr_name: str) -> music21.instrument.Instrument:
+        """
+        Get the music21 instrument of an instrument name, falling back to a piano.
+        :param instr_name: Instrument name.
+        :return: music21 Instrument.
+        """
+        try:
+            return music21.instrument.fromString(instr_name)
+        except music21.exceptions21.InstrumentException:
+            return music21.instrument.Piano()
+
+    def _get_track_writer(self, instr_name: str, channel: int) -> TrackWriter:
+        """
+        Get the cached track writer of an instrument's model on a channel, building it on first use.
+        :param instr_name: Instrument name.
+        :param channel: MIDI channel of the track.
+        :return: TrackWriter for the model's states.
+        """
+        key = (instr_name, channel)
+        if key not in self._track_writers:
+            self._track_writers[key] = TrackWriter(self._get_pitch_table(instr_name), channel=channel)
+        return self._track_writers[key]
+
+    def _get_pitch_table(self, instr_name: str) -> PitchTable:
+        """
+        Get the cached pitch table of an instrument's model, building it on first use.
+        :param instr_name: Instrument name.
+        :return: PitchTable of the model's states.
+        """
+        if instr_name not in self._pitch_tables:
+            model = self._models_by_instrument[instr_name]
+            self._pitch_tables[instr_name] = PitchTable(model.vocabulary.masks[model.decode(np.arange(model.n_states))])
+        return self._pitch_tables[instr_name]
+
+    def _drop_render_caches(self, instr_name: str) -> None:
+        """
+        Drop the pitch table and track writers of an instrument whose model was evicted from the registry.
+        :param instr_name: Instrument name.
+        :return: None
+        """
+        self._pitch_tables.pop(instr_name, None)
+        for key in [key for key in self._track_writers if key[0] == instr_name]:
+            del self._track_writers[key]
+
+    @staticmethod
+    def _write_output(output, midi_files: list[bytes]) -> None:
+        """
+        Write rendered MIDI files to a path or a binary stream.
+        :param output: Path, or object with a write() method. Several pieces written to a path get an index suffix.
+        :param midi_files: Rendered MIDI files.
+        :return: None
+        """
+        if hasattr(output, 'write'):
+            if len(midi_files) > 1:
+                raise ValueError('Several pieces cannot be written to a single stream')
+            output.write(midi_files[0])
+            return
+
+        root, extension = os.path.splitext(output)
+        for index, midi_file in enumerate(midi_files):
+            path = output if len(midi_files) == 1 else f'{root}_{index}{extension or ".mid"}'
+            with open(path, 'wb') as f:
+                f.write(midi_file)
+
+    def choose_instruments(self, instruments: list[str] | None, seed: Seed = None) -> tuple[list[str], list[np.random.Generator]]:
+        """
+        Validate the requested instruments, or choose four random ones, and derive an independent random
+        generator for each of them with SeedSequence.spawn(). Instruments never share a generator, so their
+        parts can be sampled in any order or in parallel and still reproduce a seeded request exactly.
+        :param instruments: Instruments to generate parts for. Four random instruments are chosen if None.
+        :param seed: Seed or random generator of the request. Fresh OS entropy if None.
+        :return: Tuple of (instruments, random generator of every instrument).
+        :raises ValueError: If an instrument has no model, or there are more instruments than pitched MIDI channels.
+        """
+        choice_rng, instruments_rng = spawn_generators(seed, 2)
+
+        if instruments is None:
+            instruments = [str(instr_name) for instr_name in
+                           choice_rng.choice(self._models_by_instrument.instruments, size=4, replace=False)]
+
+        unknown_instruments = [instr_name for instr_name in instruments if instr_name not in self._models_by_instrument]
+        if unknown_instruments:
+            raise ValueError(f'No model for instruments {unknown_instruments}')
+        # Every part gets its own channel in MIDI output, and channel 10 is reserved for percussion
+        if len(instruments) > len(PITCHED_CHANNELS):
+            raise ValueError(f'At most {len(PITCHED_CHANNELS)} instruments can be generated at once, got {len(instruments)}')
+
+        return list(instruments), spawn_generators(instruments_rng, len(instruments))
+
+    @staticmethod
+    def _encode_phrase(model, instr_name: str, phrase: list) -> np.ndarray:
+        """
+        Map a phrase to the state ids of a model.
+        :param model: Model of the instrument.
+        :param instr_name: Instrument name, for error messages.
+        :param phrase: Music elements, each a list of MIDI pitches (empty for a rest).
+        :return: Array of state ids.
+        :raises ValueError: If an element never occurs in the model.
+        """
+        token_ids = [model.vocabulary.lookup(pitches_to_mask(pitches)) for pitches in phrase]
+        state_ids = model.encode(np.array([-1 if token_id is None else token_id for token_id in token_ids]))
+        if (state_ids < 0).any():
+            unknown = [list(pitches) for pitches, state_id in zip(phrase, state_ids) if state_id < 0]
+            raise ValueError(f'Phrase elements {unknown} never occur in the model of {instr_name}')
+        return state_ids
+
+    def _generate_batch(self, model, instr_name: str, n_pieces: int, length: int, seed: Seed, rhythm: bool,
+                        constraints: dict) -> tuple[np.ndarray, np.ndarray | list[None]]:
+        """
+        Sample the state ids, and the durations if requested and the model has a duration chain, of every piece.
+        :param constraints: Constraints of generate_music(); constrained pieces are sampled with generate_constrained().
+        :return: Tuple of (state ids of every piece, durations of every piece or None for every piece).
+        """
+        with_durations = rhythm and model.duration_chain is not None
+        phrase = (constraints['phrases'] or {}).get(instr_name)
+        if constraints['key'] is None and constraints['avoid_pitches'] is None and constraints['end_pitch_classes'] is None \
+                and phrase is None:
+            if with_durations:
+                return model.generate_batch(n_pieces, length=length, seed=seed, with_durations=True)
+            return model.generate_batch(n_pieces, length=length, seed=seed), [None] * n_pieces
 
-    def generate_music(self, length: int = 20, laplace_smoothing: float = 1.0):
-        new_score = music21.stream.Score()
+        index = model.constraint_index
+        allowed = index.allowed_states(key=constraints['key'], avoid_pitches=constraints['avoid_pitches'])
+        end = (index.allowed_states(pitch_classes=constraints['end_pitch_classes'], allow_rests=False)
+               if constraints['end_pitch_classes'] is not None else None)
+        prefix = self._encode_phrase(model, instr_name, phrase) if phrase is not None else None
 
-        instruments = np.random.choice(list(self._models_by_instrument.keys()), size=4, replace=False)
-        print(f"Generating music for instrument: {instruments}")
+        rng = np.random.default_rng(seed)
+        try:
+            state_ids = model.generate_constrained(n_pieces, length=length, allowed=allowed, prefix=prefix, end=end, seed=rng)
+        except ValueError as e:
+            raise ValueError(f'{instr_name}: {e}') from e
+        if with_durations:
+            return state_ids, model.duration_chain.decode(model.duration_chain.generate_batch(n_pieces, length=length, seed=rng))
+        return state_ids, [None] * n_pieces
 
-        for instr_name in instruments:
+    def _generate_midi(self, instruments: list[str], instrument_rngs: list[np.random.Generator], n_pieces: int,
+                       length: int, rhythm: bool = True, constraints: dict | None = None) -> list[bytes]:
+        """
+        Sample and render MIDI pieces for instruments already chosen with choose_instruments(), e.g. by a caller
+        that needs to know the randomly chosen instruments.
+        :param instruments: Instruments to generate parts for.
+        :param instrument_rngs: Random generator of every instrument.
+        :param n_pieces: Number of pieces.
+        :param length: Number of music elements per instrument.
+        :param rhythm: Sample durations, see generate_music().
+        :param constraints: Constraints of generate_music(). None for unconstrained pieces.
+        :return: MIDI file bytes of every piece.
+        """
+        constraints = constraints if constraints is not None else _NO_CONSTRAINTS
+        tracks_by_piece = [[] for _ in range(n_pieces)]
+
+        for channel, instr_name, instr_rng in zip(PITCHED_CHANNELS, instruments, instrument_rngs):
+            model = self._models_by_instrument[instr_name]
+            track_writer = self._get_track_writer(instr_name, channel)
+            program = self._get_instrument(instr_name).midiProgram or 0
+
+            generated_sequences, generated_durations = self._generate_batch(model, instr_name, n_pieces, length,
+                                                                            instr_rng, rhythm, constraints)
+            with stage('render_tracks', instrument=instr_name):
+                for tracks, state_ids, durations in zip(tracks_by_piece, generated_sequences, generated_durations):
+                    tracks.append(track_writer.write(state_ids, program=program, durations=durations))
+
+        with stage('write_midi'):
+            midi_files = [write_midi_file(tracks) for tracks in tracks_by_piece]
+        count('pieces', n_pieces, render='midi')
+        return midi_files
+
+    @property
+    def instruments(self) -> list[str]:
+        return self._models_by_instrument.instruments
+
+    def generate_music(self, length: int = 20, laplace_smoothing: float = 1.0, n_pieces: int = 1,
+                       show: bool = True, render: str = 'music21', output=None,
+                       instruments: list[str] | None = None, seed: Seed = None, rhythm: bool = True,
+                       key: str | None = None, avoid_pitches: list[int] | None = None,
+                       end_pitch_classes: list[int] | None = None,
+                       phrases: dict[str, list[list[int]]] | None = None) -> list[music21.stream.Score] | list[bytes]:
+        """
+        Generate pieces for four randomly chosen instruments and play them.
+        All pieces of a call share the instruments; their sequences are sampled together with generate_batch().
+        :param length: Number of music elements per instrument.
+        :param n_pieces: Number of candidate pieces to generate.
+        :param instruments: Instruments to generate parts for. Four random instruments are chosen if None.
+        :param seed: Seed or random generator making the instrument choice and the sampled sequences reproducible.
+        :param show: Play the generated pieces with show('midi'). Only used by the 'music21' render mode.
+        :param render: 'music21' builds music21 Scores; 'midi' writes MIDI bytes straight from the state ids,
+                       without music21 objects or a player.
+        :param output: Only for the 'midi' render mode: path or binary stream to write the MIDI files to.
+        :param rhythm: Sample the duration of every element from the models' duration chains, in the same pass as
+                       the pitches. Models without a duration chain (saved before format 4) and rhythm=False
+                       produce quarter notes only.
+        :param key: Only use notes and chords of this key's scale, e.g. 'D minor' (see ConstraintIndex.parse_key()).
+        :param avoid_pitches: MIDI pitches never to play.
+        :param end_pitch_classes: Pitch classes (0 = C, ..., 11 = B) the last element of every part is made of,
+                                  e.g. [2, 5, 9] to end on a D minor chord.
+        :param phrases: Phrase to continue per instrument, as music elements of MIDI pitches (empty for a rest).
+                        Constrained parts are sampled with masked, renormalized rows instead of rejection sampling
+                        (see MusicalMarkovChain.generate_constrained()).
+        :return: List of generated music21 Scores, or of MIDI file bytes for the 'midi' render mode.
+        """
+        if render not in ('music21', 'midi'):
+            raise ValueError(f"Unknown render mode '{render}', expected 'music21' or 'midi'")
+
+        was_random = instruments is None
+        instruments, instrument_rngs = self.choose_instruments(instruments, seed)
+        if was_random:
+            print(f"Generating music for instrument: {instruments}")
+
+        constraints = {'key': key, 'avoid_pitches': avoid_pitches, 'end_pitch_classes': end_pitch_classes,
+                       'phrases': phrases}
+
+        if render == 'midi':
+            midi_files = self._generate_midi(instruments, instrument_rngs, n_pieces, length, rhythm, constraints)
+            if output is not None:
+                self._write_output(output, midi_files)
+            return midi_files
+
+        new_scores = [music21.stream.Score() for _ in range(n_pieces)]
+
+        for instr_name, instr_rng in zip(instruments, instrument_rngs):
             model = self._models_by_instrument[instr_name]
-            
-            try:
-                music21_instr = music21.instrument.fromString(instr_name)
-            except music21.exceptions21.InstrumentException:
-                music21_instr = music21.instrument.Piano()
-
-            generated_sequence = model.generate_sequence(length=length)
-            part = music21.stream.Part()
-            for tm_index in generated_sequence:
-                music_element = MusicDataTrainer.str_to_midi_tuple(tm_index)
-                if len(music_element) > 1: 
-                    c = music21.chord.Chord()
-                    for midi_pitch in music_element:
-                        n = music21.note.Note(midi=midi_pitch)
-                        c.add(n)
-                    c.storedInstrument = music21_instr
-                    part.append(c)
-                    continue
-                elif len(music_element) == 1 and music_element[0] == -1:
-                    r = music21.note.Rest()
-                    part.append(r)
-                    continue
-                elif len(music_element) == 1:
-                    note = music21.note.Note(midi=music_element[0])
-                    note.storedInstrument = music21_instr
-                    part.append(note)
-            part.makeMeasures()
-            new_score.append(part)
-            new_score.makeMeasures()
-
-        new_score.show('midi')
\ No newline at end of file
+            music21_instr = self._get_instrument(instr_name)
+
+            generated_sequences, generated_durations = self._generate_batch(model, instr_name, n_pieces, length,
+                                                                            instr_rng, rhythm, constraints)
+            generated_sequences = model.decode(generated_sequences)
+            with stage('build_parts', instrument=instr_name):
+                for new_score, generated_sequence, durations in zip(new_scores, generated_sequences, generated_durations):
+                    new_score.append(self._build_part(generated_sequence, model.vocabulary, music21_instr, durations))
+
+        with stage('build_scores'):
+            for new_score in new_scores:
+                new_score.makeMeasures()
+        if show:
+            with stage('show'):
+                for new_score in new_scores:
+                    new_score.show('midi')
+        count('pieces', n_pieces, render=render)
+
+        return new_scores
+
+    def stream_tokens(self, length: int | None = None, chunk_size: int = 64, instruments: list[str] | None = None,
+                      seed: Seed = None) -> Iterator[dict[str, np.ndarray]]:
+        """
+        Generate a piece incrementally, interleaving the parts chunk by chunk. The first chunk is available after
+        chunk_size steps whatever the length, and memory stays constant, so the piece can be unbounded.
+        :param length: Number of music elements per instrument. Generates forever if None.
+        :param chunk_size: Maximum number of music elements per instrument in every chunk.
+        :param instruments: Instruments to generate parts for. Four random instruments are chosen if None.
+        :param seed: Seed or random generator making the instrument choice and the sampled sequences reproducible.
+        :return: Iterator of dicts mapping every instrument to the token ids of its next music elements.
+        """
+        instruments, instrument_rngs = self.choose_instruments(instruments, seed)
+        models = [self._models_by_instrument[instr_name] for instr_name in instruments]
+        chunk_iterators = [model.iter_chunks(length=length, chunk_size=chunk_size, seed=instr_rng)
+                           for model, instr_rng in zip(models, instrument_rngs)]
+
+        for chunks in zip(*chunk_iterators):
+            yield {instr_name: model.decode(chunk[0]) for instr_name, model, chunk in zip(instruments, models, chunks)}
+
+    def stream_midi(self, length: int | None = None, chunk_size: int = 64, instruments: list[str] | None = None,
+                    seed: Seed = None) -> Iterator[bytes]:
+        """
+        Generate a piece incrementally as MIDI events, all parts merged in time order on their own channels.
+        The chunks concatenate to the events of one track; MidiWriter.track_chunk() and write_midi_file() turn
+        a finished stream into a file.
+        :param length: Number of music elements per instrument. Generates forever if None.
+        :param chunk_size: Maximum number of music elements per instrument in every chunk.
+        :param instruments: Instruments to generate parts for. Four random instruments are chosen if None.
+        :param seed: Seed or random generator making the instrument choice and the sampled sequences reproducible.
+        :return: Iterator of MIDI event bytes with delta times. The last chunk ends the track.
+        """
+        instruments, instrument_rngs = self.choose_instruments(instruments, seed)
+        channels = list(PITCHED_CHANNELS[:len(instruments)])
+        writer = InterleavedWriter([self._get_pitch_table(instr_name) for instr_name in instruments], channels,
+                                   [self._get_instrument(instr_name).midiProgram or 0 for instr_name in instruments])
+        chunk_iterators = [self._models_by_instrument[instr_name].iter_chunks(length=length, chunk_size=chunk_size,
+                                                                               seed=instr_rng)
+                           for instr_name, instr_rng in zip(instruments, instrument_rngs)]
+
+        events = writer.start()
+        for chunks in zip(*chunk_iterators):
+            with stage('render_chunk'):
+                events += writer.write([chunk[0] for chunk in chunks])
+            yield events
+            events = b''
+        yield events + writer.close()
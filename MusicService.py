@@ -0,0 +1,260 @@
+import json
+import time
+import base64
+import asyncio
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from MusicGenerator import MusicGenerator
+
+MAX_LENGTH = 100_000
+MAX_COUNT = 64
+MAX_BODY_BYTES = 64 * 1024
+
+_worker_generator = None
+
+def _init_worker(model_path: str) -> None:
+    """
+    Load the models once per worker process. They are memory-mapped, so all workers share one physical copy.
+    :param model_path: Directory of the saved models.
+    :return: None
+    """
+    global _worker_generator
+    _worker_generator = MusicGenerator(model_path=model_path)
+
+def _generate(instruments: list[str] | None, length: int, seed: int | None, count: int) -> tuple[list[str], list[bytes]]:
+    """
+    Generate and render pieces inside a worker process.
+    :param instruments: Instruments to generate parts for, or None for four random ones.
+    :param length: Number of music elements per instrument.
+    :param seed: Seed of the request, or None.
+    :param count: Number of pieces.
+    :return: Tuple of (instruments used, MIDI file bytes of every piece).
+    """
+    # Same streams as generate_music(render='midi', seed=seed), but the chosen instruments are kept for the response
+    instruments, instrument_rngs = _worker_generator.choose_instruments(instruments, seed)
+    midi_files = _worker_generator._generate_midi(instruments, instrument_rngs, count, length)
+    return instruments, midi_files
+
+class ServiceError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class MusicService:
+    def __init__(self, model_path: str, n_workers: int | None = None, max_pending: int = 64, latency_window: int = 10_000):
+        """
+        Long-running generation service. Models are loaded once per worker process, sampling and rendering run
+        on the process pool, and the event loop only parses requests and writes responses.
+        :param model_path: Directory of the saved models (see ModelStore).
+        :param n_workers: Number of worker processes. None uses all CPUs.
+        :param max_pending: Maximum number of distinct generations queued or running. Further requests are
+                            rejected with 503 until the backlog drains.
+        :param latency_window: Number of recent request latencies kept for the percentiles in stats().
+        """
+        self._instruments = MusicGenerator(model_path=model_path).instruments
+        # Workers are started lazily, after the server is listening. Forked workers would inherit the listening and
+        # client sockets and keep them open, so they are started from a clean forkserver process instead
+        self._executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('forkserver'),
+                                             initializer=_init_worker, initargs=(model_path,))
+        self._max_pending = max_pending
+        self._in_flight = {}
+        self._unkeyed_pending = 0
+        self._latencies = deque(maxlen=latency_window)
+        self._counters = {'requests': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'coalesced': 0}
+
+    def _parse_request(self, body: bytes) -> tuple[list[str] | None, int, int | None, int]:
+        """
+        Validate a generation request.
+        :param body: JSON body with optional 'instruments', 'length', 'seed' and 'count'.
+        :return: Tuple of (instruments, length, seed, count).
+        :raises ServiceError: If the request is malformed.
+        """
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            raise ServiceError(400, 'Request body is not valid JSON')
+        if not isinstance(request, dict):
+            raise ServiceError(400, 'Request body must be a JSON object')
+
+        instruments = request.get('instruments')
+        length = request.get('length', 20)
+        seed = request.get('seed')
+        count = request.get('count', 1)
+
+        if instruments is not None:
+            if not isinstance(instruments, list) or not instruments or len(instruments) > 15:
+                raise ServiceError(400, "'instruments' must be a list of 1 to 15 instrument names")
+            unknown_instruments = [instr_name for instr_name in instruments if instr_name not in self._instruments]
+            if unknown_instruments:
+                raise ServiceError(400, f'Unknown instruments: {unknown_instruments}')
+        if not isinstance(length, int) or not 1 <= length <= MAX_LENGTH:
+            raise ServiceError(400, f"'length' must be an integer between 1 and {MAX_LENGTH}")
+        if not isinstance(count, int) or not 1 <= count <= MAX_COUNT:
+            raise ServiceError(400, f"'count' must be an integer between 1 and {MAX_COUNT}")
+        if seed is not None and (not isinstance(seed, int) or seed < 0):
+            raise ServiceError(400, "'seed' must be a non-negative integer")
+
+        return instruments, length, seed, count
+
+    async def generate(self, instruments: list[str] | None, length: int, seed: int | None, count: int) -> tuple[list[str], list[bytes]]:
+        """
+        Run a generation on the worker pool. Seeded requests identical to one already in flight share its result
+        instead of generating again.
+        :return: Tuple of (instruments used, MIDI file bytes of every piece).
+        :raises ServiceError: With status 503 if the backlog is full.
+        """
+        key = (tuple(instruments) if instruments is not None else None, length, seed, count) if seed is not None else None
+
+        if key is not None and key in self._in_flight:
+            self._counters['coalesced'] += 1
+            return await asyncio.shield(self._in_flight[key])
+
+        if len(self._in_flight) + self._unkeyed_pending >= self._max_pending:
+            self._counters['rejected'] += 1
+            raise ServiceError(503, 'Too many pending requests')
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, _generate, instruments, length, seed, count)
+
+        if key is None:
+            self._unkeyed_pending += 1
+            try:
+                return await future
+            finally:
+                self._unkeyed_pending -= 1
+
+        self._in_flight[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self._in_flight.pop(key, None)
+
+    def stats(self) -> dict:
+        """
+        Counters and latency percentiles (in milliseconds) of the recent requests.
+        :return: Dict of service statistics.
+        """
+        latencies = np.array(self._latencies) * 1000
+        percentiles = {f'p{p}': float(np.percentile(latencies, p)) for p in (50, 90, 99)} if len(latencies) else {}
+
+        return {**self._counters, 'pending': len(self._in_flight) + self._unkeyed_pending,
+                'latency_ms': percentiles, 'instruments': self._instruments}
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, payload: dict) -> None:
+        """
+        Write a JSON response and close the connection.
+        """
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error',
+                   503: 'Service Unavailable'}
+        body = json.dumps(payload).encode()
+        headers = [f'HTTP/1.1 {status} {reasons.get(status, "")}', 'Content-Type: application/json',
+                   f'Content-Length: {len(body)}', 'Connection: close']
+        if status == 503:
+            headers.append('Retry-After: 1')
+
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode() + body)
+        await writer.drain()
+        writer.close()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serve one HTTP/1.1 request: POST /generate, GET /stats or GET /health. Every request is counted, and
+        ends up as completed, failed or rejected unless the client disconnects first.
+        """
+        start = time.perf_counter()
+        self._counters['requests'] += 1
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if len(request_line) < 2:
+                raise ServiceError(400, 'Malformed request line')
+            method, path = request_line[0], request_line[1]
+
+            try:
+                content_length = int(headers.get('content-length', 0))
+            except ValueError:
+                raise ServiceError(400, 'Content-Length must be an integer')
+            if content_length < 0:
+                raise ServiceError(400, 'Content-Length must not be negative')
+            if content_length > MAX_BODY_BYTES:
+                raise ServiceError(413, 'Request body too large')
+            body = await reader.readexactly(content_length) if content_length else b''
+
+            if method == 'GET' and path == '/health':
+                self._counters['completed'] += 1
+                await self._respond(writer, 200, {'status': 'ok'})
+            elif method == 'GET' and path == '/stats':
+                self._counters['completed'] += 1
+                await self._respond(writer, 200, self.stats())
+            elif method == 'POST' and path == '/generate':
+                instruments, length, seed, count = self._parse_request(body)
+                used_instruments, midi_files = await self.generate(instruments, length, seed, count)
+
+                self._counters['completed'] += 1
+                self._latencies.append(time.perf_counter() - start)
+                await self._respond(writer, 200, {
+                    'instruments': used_instruments,
+                    'pieces': [base64.b64encode(midi_file).decode() for midi_file in midi_files],
+                })
+            else:
+                raise ServiceError(404, f'No route for {method} {path}')
+        except ServiceError as e:
+            if e.status != 503:
+                self._counters['failed'] += 1
+            await self._respond(writer, e.status, {'error': e.message})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+        except Exception as e:
+            self._counters['failed'] += 1
+            await self._respond(writer, 500, {'error': f'{type(e).__name__}: {e}'})
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8000, unix_path: str | None = None) -> None:
+        """
+        Accept connections until cancelled, on a Unix socket if unix_path is given, otherwise on host:port.
+        """
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+
+        async with server:
+            await server.serve_forever()
+
+    def close(self) -> None:
+        self._executor.shutdown(cancel_futures=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve music generation requests from warm, memory-mapped models.')
+    parser.add_argument('--model-path', default='models', help='Directory of saved models; trained from --data-path if missing')
+    parser.add_argument('--data-path', default='MIDI_files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', default=None, help='Listen on this Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-pending', type=int, default=64)
+    args = parser.parse_args()
+
+    # Trains and saves the models once if they do not exist yet
+    MusicGenerator(data_path=args.data_path, model_path=args.model_path)
+
+    service = MusicService(args.model_path, n_workers=args.workers, max_pending=args.max_pending)
+    try:
+        asyncio.run(service.serve(host=args.host, port=args.port, unix_path=args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+if __name__ == '__main__':
+    main()
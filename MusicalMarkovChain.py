@@ -1,30 +1,561 @@
 import os
+import json
+import asyncio
 import music21
 import numpy as np
-import pandas as pd
+from typing import AsyncIterator, Iterator
+from ConstraintIndex import ConstraintIndex, MaskedRows
+from ContextIndex import ContextIndex, extend_hashes, hash_contexts
+from Instrumentation import count, stage
+from SparseTransitionMatrix import SparseTransitionMatrix
+from Vocabulary import Vocabulary
+
+# Anything a random stream can be derived from: an int seed, a SeedSequence or a Generator (used as is)
+Seed = int | np.random.SeedSequence | np.random.Generator | None
+
+def spawn_generators(seed: Seed, n: int) -> list[np.random.Generator]:
+    """
+    Derive independent random generators with SeedSequence.spawn(), e.g. one per instrument of a request.
+    The same seed always gives the same generators and their streams do not overlap, so work split across
+    threads or processes is reproducible and never shares a generator.
+    :param seed: Seed to derive the generators from. Fresh OS entropy if None.
+    :param n: Number of generators.
+    :return: List of n random generators.
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed.spawn(n)
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return [np.random.default_rng(child) for child in seed_sequence.spawn(n)]
 
 class MusicalMarkovChain:
-    def __init__(self, transition_matrix: pd.DataFrame, starting_probabilities: pd.Series):
+    # Arrays derived from the transition matrix at construction; saved alongside it so loading skips the rebuild
+    _SAMPLING_TABLES = ('_cumulative_counts', '_row_offsets', '_row_totals', '_row_smoothing', '_row_weights', '_starting_cdf')
+
+    def __init__(self, vocabulary: Vocabulary | None, states: np.ndarray, transition_matrix: SparseTransitionMatrix,
+                 starting_probabilities: np.ndarray,
+                 sampling_tables: dict[str, np.ndarray] | None = None, context_indices: list[ContextIndex] | None = None,
+                 duration_chain: 'MusicalMarkovChain | None' = None, constraint_index: ConstraintIndex | None = None):
+        """
+        :param vocabulary: Vocabulary of the tokens the states stand for. None if the tokens are plain integers,
+                           like the durations of a duration chain.
+        :param states: Token id of every state id.
+        :param transition_matrix: Sparse transition counts between state ids.
+        :param starting_probabilities: Probability of every state id being the first element.
+        :param sampling_tables: Precomputed sampling tables, e.g. memory-mapped from a saved model. Built if None.
+        :param context_indices: Context indices of orders 2, 3, ... for a higher-order model. Sampling uses the
+                                longest observed context and backs off to shorter ones, down to the first-order matrix.
+        :param duration_chain: Chain over the durations of the music elements, sampled together with the pitches
+                               when durations are requested (see iter_chunks()).
+        :param constraint_index: Musical properties of the states for constrained generation. Built on first use if None.
+        """
+        self.vocabulary = vocabulary
+        self.duration_chain = duration_chain
+        self._constraint_index = constraint_index
+        self._state_ids = None
+        self._states = states
         self._transition_matrix = transition_matrix
         self._starting_probabilities = starting_probabilities
-    
-    def generate_sequence(self, length: int = 50) -> list:
+        self._context_indices = context_indices if context_indices is not None else []
+
+        if sampling_tables is None:
+            self._build_sampling_tables()
+        else:
+            for name in self._SAMPLING_TABLES:
+                setattr(self, name, sampling_tables[name])
+
+    def save(self, directory: str) -> None:
+        """
+        Save the model as one .npy file per array plus a small JSON header, so it can be memory-mapped by load().
+        States are saved as their pitch-set masks, since token ids are only meaningful within one vocabulary.
+        The duration chain, if any, is saved to the 'durations' subdirectory.
+
+        :param directory: Directory to write the model files to. Created if missing.
+        :return: None
+        """
+        os.makedirs(directory, exist_ok=True)
+        tm = self._transition_matrix
+
+        arrays = {
+            'indptr': tm.indptr,
+            'indices': tm.indices,
+            'counts': tm.counts,
+            'row_counts': tm.row_totals,
+            'starting_probabilities': self._starting_probabilities,
+        }
+        for name in self._SAMPLING_TABLES:
+            arrays[name.lstrip('_')] = getattr(self, name)
+
+        if self.vocabulary is not None:
+            arrays['state_masks'] = self.vocabulary.masks[self._states]
+        else:
+            arrays['state_values'] = self._states
+
+        for context_index in self._context_indices:
+            prefix = f'context_{context_index.order}_'
+            for name in ('keys', 'indptr', 'indices', 'counts') + ContextIndex.SAMPLING_TABLES:
+                arrays[prefix + name] = getattr(context_index, name)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), np.ascontiguousarray(array))
+
+        with open(os.path.join(directory, 'header.json'), 'w') as f:
+            json.dump({'n_states': tm.n_states, 'laplace_smoothing': tm.laplace_smoothing, 'order': self.order}, f)
+
+        if self.duration_chain is not None:
+            self.duration_chain.save(os.path.join(directory, 'durations'))
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True, vocabulary: Vocabulary | None = None) -> 'MusicalMarkovChain':
+        """
+        Load a model written by save().
+
+        :param directory: Directory containing the model files.
+        :param mmap: Memory-map the arrays read-only instead of reading them, so processes loading the same model share its pages.
+        :param vocabulary: Vocabulary to intern the states into, e.g. one shared by all models of a set. A new one if None.
+        :return: Loaded MusicalMarkovChain.
+        :rtype: MusicalMarkovChain
+        """
+        with stage('load_model', mmap=mmap):
+            mmap_mode = 'r' if mmap else None
+
+            def load_array(name: str) -> np.ndarray:
+                return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+
+            with open(os.path.join(directory, 'header.json'), 'r') as f:
+                header = json.load(f)
+
+            transition_matrix = SparseTransitionMatrix(load_array('indptr'), load_array('indices'), load_array('counts'),
+                                                       header['n_states'], header['laplace_smoothing'],
+                                                       row_totals=load_array('row_counts'))
+            sampling_tables = {name: load_array(name.lstrip('_')) for name in cls._SAMPLING_TABLES}
+
+            context_indices = []
+            for order in range(2, header.get('order', 1) + 1):
+                prefix = f'context_{order}_'
+                context_indices.append(ContextIndex(
+                    order, load_array(prefix + 'keys'), load_array(prefix + 'indptr'), load_array(prefix + 'indices'),
+                    load_array(prefix + 'counts'),
+                    sampling_tables={name: load_array(prefix + name) for name in ContextIndex.SAMPLING_TABLES}))
+
+            if os.path.isfile(os.path.join(directory, 'state_values.npy')):
+                vocabulary = None
+                states = np.load(os.path.join(directory, 'state_values.npy'))
+            elif os.path.isfile(os.path.join(directory, 'state_masks.npy')):
+                vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+                states = vocabulary.intern_masks(np.load(os.path.join(directory, 'state_masks.npy')))
+            else:
+                # Models saved before format version 3 store the music element strings
+                vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+                states = vocabulary.intern_tokens(np.load(os.path.join(directory, 'states.npy')))
+
+            duration_directory = os.path.join(directory, 'durations')
+            duration_chain = cls.load(duration_directory, mmap=mmap) if os.path.isdir(duration_directory) else None
+
+            return cls(vocabulary, states, transition_matrix, load_array('starting_probabilities'),
+                       sampling_tables=sampling_tables, context_indices=context_indices,
+                       duration_chain=duration_chain)
+
+    @property
+    def n_states(self) -> int:
+        return len(self._states)
+
+    @property
+    def order(self) -> int:
+        return 1 + len(self._context_indices)
+
+    @property
+    def constraint_index(self) -> ConstraintIndex:
+        """
+        Musical properties of the states (see ConstraintIndex), e.g. to build the allowed states of generate_constrained().
+        Trained models get it from analyze_data(); loaded models build it on first use.
+        """
+        if self._constraint_index is None:
+            if self.vocabulary is None:
+                raise ValueError('Only models over pitch sets have a constraint index')
+            self._constraint_index = ConstraintIndex(self.vocabulary.masks[self._states], self._transition_matrix)
+        return self._constraint_index
+
+    def memory_usage(self) -> dict[int, int]:
+        """
+        Bytes held by the model, by order. Order 1 includes the states, the first-order matrix, all sampling tables
+        and the duration chain.
+
+        :return: Dictionary mapping each order to its size in bytes.
+        :rtype: dict[int, int]
+        """
+        tm = self._transition_matrix
+        arrays = [self._states, tm.indptr, tm.indices, tm.counts, tm.row_totals, self._starting_probabilities]
+        arrays += [getattr(self, name) for name in self._SAMPLING_TABLES]
+
+        memory = {1: sum(array.nbytes for array in arrays)}
+        if self._constraint_index is not None:
+            memory[1] += self._constraint_index.nbytes
+        if self.duration_chain is not None:
+            memory[1] += sum(self.duration_chain.memory_usage().values())
+        for context_index in self._context_indices:
+            memory[context_index.order] = context_index.nbytes
+
+        return memory
+
+    def _build_sampling_tables(self) -> None:
+        """
+        Precompute the cumulative distributions used for sampling, so each step is a single binary search.
+        Every row's mass is split into its observed counts followed by the implicit Laplace smoothing mass.
+        The observed counts of all rows are stacked into one global cumulative array, so a draw inside row i
+        is found by searching for row_offset[i] + x in it.
+        :return: None
+        """
+        tm = self._transition_matrix
+        n_states = tm.n_states
+
+        self._cumulative_counts = np.cumsum(tm.counts, dtype=np.float64)
+        self._row_offsets = np.concatenate(([0.0], self._cumulative_counts))[tm.indptr[:-1]]
+        self._row_totals = tm.row_totals.astype(np.float64)
+
+        # Rows with no mass at all (no observations, no smoothing) sample uniformly
+        self._row_smoothing = np.full(n_states, float(tm.laplace_smoothing))
+        self._row_smoothing[self._row_totals + self._row_smoothing * n_states == 0] = 1.0
+        self._row_weights = self._row_totals + self._row_smoothing * n_states
+        # Without smoothing every draw lands in the observed counts, so the divisor only has to be non-zero
+        self._row_smoothing[self._row_smoothing == 0] = 1.0
+
+        self._starting_cdf = np.cumsum(self._starting_probabilities, dtype=np.float64)
+        self._starting_cdf /= self._starting_cdf[-1]
+
+    def _sample_first_order(self, current_states: np.ndarray, uniforms: np.ndarray) -> np.ndarray:
+        """
+        Draw the next state for each current state from the first-order matrix, using uniform [0, 1) numbers.
+        :param current_states: Array of current state ids.
+        :param uniforms: Array of uniform random numbers, same shape as current_states.
+        :return: Array of next state ids.
+        """
+        x = uniforms * self._row_weights[current_states]
+        row_totals = self._row_totals[current_states]
+        observed = x < row_totals
+
+        positions = np.searchsorted(self._cumulative_counts, self._row_offsets[current_states] + x, side='right')
+        # Clamp to the row's last entry in case floating point rounding pushed the search past it
+        positions = np.minimum(positions, np.maximum(self._transition_matrix.indptr[current_states + 1] - 1, 0))
+        observed_states = self._transition_matrix.indices[positions]
+        smoothed_states = np.minimum(((x - row_totals) / self._row_smoothing[current_states]).astype(np.int64),
+                                     self._transition_matrix.n_states - 1)
+
+        return np.where(observed, observed_states, smoothed_states)
+
+    def _sample_next(self, history: np.ndarray, uniforms: np.ndarray) -> np.ndarray:
+        """
+        Draw the next state of each sequence from its most recent states.
+        The longest context found in the context indices is used; unseen contexts back off to shorter ones.
+        :param history: Array of shape (n, h) with the last h (at most order) states of every sequence, newest last.
+        :param uniforms: Array of n uniform random numbers.
+        :return: Array of n next state ids.
+        """
+        next_states = self._sample_first_order(history[:, -1], uniforms)
+        if not self._context_indices:
+            return next_states
+
+        hashes = hash_contexts(history[:, -1:])
+        lookups = []
+        for context_index in self._context_indices:
+            if history.shape[1] < context_index.order:
+                break
+            hashes = extend_hashes(hashes, history[:, -context_index.order])
+            lookups.append((context_index, *context_index.lookup(hashes)))
+
+        resolved = np.zeros(len(next_states), dtype=bool)
+        for context_index, rows, found in reversed(lookups):
+            use = found & ~resolved
+            if use.any():
+                next_states[use] = context_index.sample(rows[use], uniforms[use])
+                resolved |= use
+
+        return next_states
+
+    def generate_sequence(self, length: int = 50, seed: Seed = None) -> np.ndarray:
         """
         Generate a sequence of states based on the Markov Chain model.
-        
+
         :param length: Length of the sequence to generate.
         :type length: int
-        :return: Generated sequence of states.
-        :rtype: list
-        """
-        states = self._transition_matrix.index.tolist()
-        current_state = np.random.choice(states, p=self._starting_probabilities.values)
-        sequence = [current_state]
-        
-        for _ in range(1, length):
-            current_row = self._transition_matrix.loc[current_state]
-            next_state = np.random.choice(states, p=current_row.values)
-            sequence.append(next_state)
-            current_state = next_state
-        
-        return sequence
\ No newline at end of file
+        :param seed: Seed or random generator to sample with. Fresh OS entropy if None.
+        :return: Generated sequence of token ids. Use vocabulary.to_strings() for readable music elements.
+        :rtype: np.ndarray
+        """
+        return self.decode(self.generate_batch(1, length=length, seed=seed)[0])
+
+    def generate_batch(self, n_sequences: int, length: int = 50, seed: Seed = None,
+                       with_durations: bool = False) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+        """
+        Generate many sequences at once. All chains advance in lockstep, so each step is one vectorized
+        uniform draw and one search over the stacked cumulative counts for the whole batch.
+
+        :param n_sequences: Number of sequences to generate.
+        :param length: Length of every sequence.
+        :param seed: Seed for a dedicated random generator, or a generator to sample with. A generator with fresh
+                     OS entropy is created for every call if None, so concurrent callers never share one.
+        :param with_durations: Also sample the duration of every element from the duration chain, in the same pass.
+        :return: Array of state ids of shape (n_sequences, length). Use decode() to get the token ids.
+                 With durations, a tuple of that array and an array of the same shape of durations
+                 (in units of 1 / DURATION_RESOLUTION quarter notes).
+        :rtype: np.ndarray | tuple[np.ndarray, np.ndarray]
+        """
+        sequences = np.empty((n_sequences, length), dtype=np.int32)
+        durations = np.empty((n_sequences, length), dtype=np.int32) if with_durations else None
+
+        with stage('generate_batch', order=self.order, durations=with_durations):
+            position = 0
+            for chunk in self.iter_chunks(n_sequences, length=length, chunk_size=max(length, 1), seed=seed,
+                                          with_durations=with_durations):
+                if with_durations:
+                    chunk, duration_chunk = chunk
+                    durations[:, position:position + chunk.shape[1]] = duration_chunk
+                sequences[:, position:position + chunk.shape[1]] = chunk
+                position += chunk.shape[1]
+
+        return (sequences, durations) if with_durations else sequences
+
+    def iter_chunks(self, n_sequences: int = 1, length: int | None = None, chunk_size: int = 64,
+                    seed: Seed = None, with_durations: bool = False) -> Iterator[np.ndarray | tuple[np.ndarray, np.ndarray]]:
+        """
+        Generate sequences incrementally, chunk_size steps at a time. Only the last order states of every
+        sequence are kept between chunks, so memory stays constant however long the sequences get.
+        The chunks of a seeded call concatenate to the same sequences as generate_batch() with that seed.
+
+        :param n_sequences: Number of sequences advanced in lockstep.
+        :param length: Total length of every sequence. Generates forever if None.
+        :param chunk_size: Maximum number of steps per chunk.
+        :param seed: Seed for a dedicated random generator, or a generator to sample with. Fresh OS entropy if None.
+        :param with_durations: Also sample durations from the duration chain. Every step then draws the uniforms
+                               of the pitches and the durations at once.
+        :return: Iterator of state id arrays of shape (n_sequences, at most chunk_size), or with durations of
+                 tuples of such an array and the durations of its elements.
+        :rtype: Iterator[np.ndarray | tuple[np.ndarray, np.ndarray]]
+        """
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1')
+
+        duration_chain = self.duration_chain if with_durations else None
+        if with_durations and duration_chain is None:
+            raise ValueError('The model has no duration chain')
+
+        rng = np.random.default_rng(seed)
+        order = self.order
+        duration_order = duration_chain.order if duration_chain is not None else 0
+        n_carried = max(order, duration_order)
+        # The first n_carried columns carry the end of the previous chunk as history for the next one
+        buffer = np.empty((n_sequences, n_carried + chunk_size), dtype=np.int32)
+        duration_buffer = np.empty_like(buffer) if duration_chain is not None else None
+        n_history = 0
+        produced = 0
+
+        while length is None or produced < length:
+            size = chunk_size if length is None else min(chunk_size, length - produced)
+            end = n_history + size
+
+            for position in range(n_history, end):
+                if duration_chain is not None:
+                    uniforms, duration_uniforms = rng.random((2, n_sequences))
+                else:
+                    uniforms = rng.random(n_sequences)
+
+                if position == 0:
+                    buffer[:, 0] = np.searchsorted(self._starting_cdf, uniforms, side='right')
+                    if duration_chain is not None:
+                        duration_buffer[:, 0] = np.searchsorted(duration_chain._starting_cdf, duration_uniforms, side='right')
+                else:
+                    buffer[:, position] = self._sample_next(buffer[:, max(0, position - order):position], uniforms)
+                    if duration_chain is not None:
+                        duration_buffer[:, position] = duration_chain._sample_next(
+                            duration_buffer[:, max(0, position - duration_order):position], duration_uniforms)
+
+            count('generated_tokens', n_sequences * size)
+            if duration_chain is not None:
+                yield buffer[:, n_history:end].copy(), duration_chain.decode(duration_buffer[:, n_history:end])
+            else:
+                yield buffer[:, n_history:end].copy()
+            produced += size
+
+            n_history = min(n_carried, end)
+            buffer[:, :n_history] = buffer[:, end - n_history:end]
+            if duration_chain is not None:
+                duration_buffer[:, :n_history] = duration_buffer[:, end - n_history:end]
+
+    async def aiter_chunks(self, n_sequences: int = 1, length: int | None = None, chunk_size: int = 64,
+                           seed: Seed = None) -> AsyncIterator[np.ndarray]:
+        """
+        Asynchronous version of iter_chunks(). Control returns to the event loop after every chunk,
+        so chunk_size bounds how long sampling blocks other tasks.
+
+        :return: Async iterator of state id arrays of shape (n_sequences, at most chunk_size).
+        :rtype: AsyncIterator[np.ndarray]
+        """
+        for chunk in self.iter_chunks(n_sequences, length=length, chunk_size=chunk_size, seed=seed):
+            yield chunk
+            await asyncio.sleep(0)
+
+    def _backward_filter(self, allowed_weights: np.ndarray, end: np.ndarray, length: int) -> list[np.ndarray]:
+        """
+        Backward messages of an end constraint: for every step, the (rescaled) probability of each state of
+        reaching an allowed end state through allowed states only, under the first-order chain.
+        :param allowed_weights: 1.0 for every allowed state id, 0.0 otherwise.
+        :param end: Boolean array of the state ids allowed as the last element.
+        :param length: Number of steps.
+        :return: List of length arrays; element t weights the state drawn at step t. Steps before the messages
+                 converge share one array.
+        """
+        tm = self._transition_matrix
+        entry_rows = np.repeat(np.arange(tm.n_states), np.diff(tm.indptr))
+        # Smoothing mass of every row per next state (see _build_sampling_tables())
+        smoothing = (self._row_weights - self._row_totals) / tm.n_states
+
+        messages = [allowed_weights * end]
+        for remaining in range(length - 1, 0, -1):
+            following = messages[-1]
+            observed = np.bincount(entry_rows, weights=tm.counts * following[tm.indices], minlength=tm.n_states)
+            message = allowed_weights * (observed + smoothing * following.sum()) / self._row_weights
+            # Only ratios within a step matter, so rescaling keeps long sequences from underflowing
+            peak = message.max(initial=0.0)
+            message = message / peak if peak > 0 else message
+            # Far from the end the messages reach a fixed point. All earlier steps share its array, so the sampler
+            # builds their masked rows once instead of once per step
+            if np.allclose(message, following, rtol=1e-12, atol=0.0):
+                messages.extend([following] * remaining)
+                break
+            messages.append(message)
+
+        return messages[::-1]
+
+    def generate_constrained(self, n_sequences: int = 1, length: int = 50, allowed: np.ndarray | None = None,
+                             prefix: np.ndarray | None = None, end: np.ndarray | None = None,
+                             seed: Seed = None) -> np.ndarray:
+        """
+        Generate sequences that only use allowed states and, optionally, continue a phrase and end in given states.
+        Instead of rejection sampling, forbidden states are masked out of every row and the rows renormalized
+        on the fly (see ConstraintIndex.MaskedRows). End constraints are met exactly with backward filtering:
+        every step is weighted by the probability of still reaching an allowed end state, so no draw leads into a
+        dead end. A constrained batch costs one pass over the transition counts per distinct weighting on top
+        of the unconstrained sampling. Context indices are masked the same way; unobserved or fully masked
+        contexts back off to shorter ones. The end weights come from the first-order chain.
+        Without an end constraint, a sequence reaching a state without allowed successors restarts from an
+        allowed starting state.
+
+        :param n_sequences: Number of sequences to generate.
+        :param length: Number of states to generate after the prefix.
+        :param allowed: Boolean array of allowed state ids, e.g. from constraint_index.allowed_states(). All if None.
+        :param prefix: State ids to continue from (see encode()); the context of the first generated states.
+        :param end: Boolean array of the state ids allowed as the last generated element.
+        :param seed: Seed for a dedicated random generator, or a generator to sample with. Fresh OS entropy if None.
+        :return: Array of state ids of shape (n_sequences, length), without the prefix.
+        :rtype: np.ndarray
+        :raises ValueError: If no sequence satisfies the constraints.
+        """
+        rng = np.random.default_rng(seed)
+        order = self.order
+        allowed_weights = (np.ones(self.n_states) if allowed is None
+                           else np.asarray(allowed, dtype=bool).astype(np.float64))
+        prefix = np.asarray(prefix if prefix is not None else [], dtype=np.int32)
+        if length < 1:
+            return np.empty((n_sequences, 0), dtype=np.int32)
+
+        step_weights = (self._backward_filter(allowed_weights, np.asarray(end, dtype=bool), length) if end is not None
+                        else [allowed_weights] * length)
+
+        sequences = np.empty((n_sequences, len(prefix) + length), dtype=np.int32)
+        sequences[:, :len(prefix)] = prefix
+
+        with stage('generate_constrained', order=self.order, end=end is not None):
+            tm = self._transition_matrix
+            # Smoothing mass of every row per next state (see _build_sampling_tables())
+            smoothing = (self._row_weights - self._row_totals) / tm.n_states
+            weights = None
+
+            for step in range(length):
+                position = len(prefix) + step
+                if step_weights[step] is not weights:
+                    weights = step_weights[step]
+                    observed_rows = MaskedRows(tm.indptr, tm.indices, tm.counts, weights)
+                    context_rows = [MaskedRows(context_index.indptr, context_index.indices, context_index.counts, weights)
+                                    for context_index in self._context_indices]
+                    cumulative_weights = np.cumsum(weights)
+                    last_weighted = int(np.flatnonzero(weights)[-1]) if cumulative_weights[-1] > 0 else 0
+                    starting_cdf = np.cumsum(self._starting_probabilities * weights)
+                    # Without allowed starting states, sequences start uniformly among the allowed states
+                    if starting_cdf[-1] <= 0:
+                        starting_cdf = cumulative_weights
+                uniforms = rng.random(n_sequences)
+
+                if position > 0:
+                    current_states = sequences[:, position - 1]
+                    smoothing_mass = smoothing[current_states] * cumulative_weights[-1]
+                    row_weights = observed_rows.row_totals[current_states] + smoothing_mass
+                    restart = row_weights <= 0
+                else:
+                    restart = np.ones(n_sequences, dtype=bool)
+
+                if restart.any():
+                    if starting_cdf[-1] <= 0 or (position > 0 and end is not None):
+                        raise ValueError('No sequence satisfies the constraints')
+                    sequences[restart, position] = np.minimum(
+                        np.searchsorted(starting_cdf, uniforms[restart] * starting_cdf[-1], side='right'), last_weighted)
+                if restart.all():
+                    continue
+
+                # First-order draw: observed counts first, then the smoothing mass spread over the weighted states
+                active = ~restart
+                rows = current_states[active]
+                x = uniforms[active] * row_weights[active]
+                row_totals = observed_rows.row_totals[rows]
+                in_observed = (x < row_totals) | (smoothing_mass[active] <= 0)
+                next_states = np.empty(len(rows), dtype=np.int64)
+                next_states[in_observed] = observed_rows.sample(rows[in_observed], x[in_observed])
+                smoothed_x = (x[~in_observed] - row_totals[~in_observed]) / smoothing[rows[~in_observed]]
+                next_states[~in_observed] = np.minimum(np.searchsorted(cumulative_weights, smoothed_x, side='right'),
+                                                       last_weighted)
+
+                # Longest observed context with allowed successors wins
+                history = sequences[active, max(0, position - order):position]
+                hashes = hash_contexts(history[:, -1:])
+                resolved = np.zeros(len(rows), dtype=bool)
+                lookups = []
+                for context_index, masked_rows in zip(self._context_indices, context_rows):
+                    if history.shape[1] < context_index.order:
+                        break
+                    hashes = extend_hashes(hashes, history[:, -context_index.order])
+                    lookups.append((masked_rows, *context_index.lookup(hashes)))
+                for masked_rows, context_rows_found, found in reversed(lookups):
+                    use = found & ~resolved
+                    use[use] = masked_rows.row_totals[context_rows_found[use]] > 0
+                    if use.any():
+                        next_states[use] = masked_rows.sample(context_rows_found[use],
+                                                              uniforms[active][use] * masked_rows.row_totals[context_rows_found[use]])
+                        resolved |= use
+
+                sequences[active, position] = next_states
+
+            count('generated_tokens', n_sequences * length)
+
+        return sequences[:, len(prefix):]
+
+    def encode(self, token_ids: np.ndarray) -> np.ndarray:
+        """
+        Map token ids of the model's vocabulary to state ids, e.g. to continue a phrase with generate_constrained().
+        :param token_ids: Array of token ids.
+        :return: Array of state ids, -1 for tokens that are not states of the model.
+        """
+        if self._state_ids is None:
+            self._state_ids = np.full(int(np.max(self._states, initial=-1)) + 1, -1, dtype=np.int32)
+            self._state_ids[self._states] = np.arange(len(self._states))
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        in_range = (token_ids >= 0) & (token_ids < len(self._state_ids))
+        return np.where(in_range, self._state_ids[np.where(in_range, token_ids, 0)], -1).astype(np.int32)
+
+    def decode(self, state_ids: np.ndarray) -> np.ndarray:
+        """
+        Map state ids to the token ids of their music elements in the model's vocabulary
+        (or to their values for a chain without vocabulary).
+
+        :param state_ids: Array of state ids of any shape.
+        :return: Array of token ids with the same shape.
+        :rtype: np.ndarray
+        """
+        return self._states[state_ids]
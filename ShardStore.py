@@ -0,0 +1,88 @@
+import os
+import json
+from typing import Iterator
+import numpy as np
+
+# Bump whenever the on-disk layout of count shards changes
+SHARD_FORMAT_VERSION = 1
+
+def split_shards(midi_paths: list[str], n_shards: int) -> list[list[str]]:
+    """
+    Split MIDI files into shards of consecutive paths, e.g. to count them on several machines.
+    The split only depends on the paths, so every node computes the same shards.
+    :param midi_paths: Paths of the MIDI files, e.g. from find_midi_files().
+    :param n_shards: Number of shards.
+    :return: List of n_shards lists of paths, in sorted order, differing in size by at most one.
+    """
+    midi_paths = sorted(midi_paths)
+    bounds = np.linspace(0, len(midi_paths), n_shards + 1).round().astype(int)
+    return [midi_paths[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+def save_shard(shard_dir: str, manifest: dict, vocabulary_masks: np.ndarray,
+               counts: dict[str, tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]) -> None:
+    """
+    Save the raw counts of one shard. Every instrument gets its own numbered .npz file,
+    and shard.json maps instrument names to them.
+    :param shard_dir: Directory to save the shard to. Created if missing.
+    :param manifest: Metadata of the shard, e.g. the tokenizer and max_order it was counted with.
+    :param vocabulary_masks: Pitch-set mask of every token id used by the counts (see Vocabulary.masks).
+    :param counts: Dictionary mapping instrument names to the arrays of their pitch and duration counts
+                   (see TransitionCounts.to_arrays()).
+    :return: None
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    np.save(os.path.join(shard_dir, 'vocabulary.npy'), vocabulary_masks)
+    instruments = {}
+
+    for index, (instr_name, (arrays, duration_arrays)) in enumerate(counts.items()):
+        filename = f'{index:04d}.npz'
+        np.savez(os.path.join(shard_dir, filename), **arrays,
+                 **{f'durations_{name}': array for name, array in duration_arrays.items()})
+        instruments[instr_name] = filename
+
+    # Written last, so a directory with a manifest always holds a complete shard
+    with open(os.path.join(shard_dir, 'shard.json'), 'w') as f:
+        json.dump({**manifest, 'format_version': SHARD_FORMAT_VERSION, 'instruments': instruments}, f, indent=2)
+
+def read_shard_manifest(shard_dir: str) -> dict:
+    """
+    Read the manifest of a shard saved by save_shard().
+    :param shard_dir: Directory of the shard.
+    :return: Manifest dict with 'format_version', 'instruments' (instrument name to file) and the saved metadata.
+    :raises ValueError: If the shard was saved in an unsupported format version.
+    """
+    with open(os.path.join(shard_dir, 'shard.json'), 'r') as f:
+        manifest = json.load(f)
+
+    if manifest['format_version'] != SHARD_FORMAT_VERSION:
+        raise ValueError(f"Unsupported shard format version {manifest['format_version']}, expected {SHARD_FORMAT_VERSION}")
+
+    return manifest
+
+def load_shard_vocabulary(shard_dir: str) -> np.ndarray:
+    """
+    :param shard_dir: Directory of the shard.
+    :return: Pitch-set mask of every token id of the shard's counts, as an array of shape (n, 2).
+    """
+    return np.load(os.path.join(shard_dir, 'vocabulary.npy'))
+
+def iter_shard_counts(shard_dir: str, manifest: dict) -> Iterator[tuple[str, dict[str, np.ndarray], dict[str, np.ndarray]]]:
+    """
+    Load the counts of a shard one instrument at a time, so merging holds a single instrument's arrays at once.
+    :param shard_dir: Directory of the shard.
+    :param manifest: Manifest from read_shard_manifest().
+    :return: Iterator of (instrument name, pitch count arrays, duration count arrays) tuples.
+    """
+    for instr_name, filename in manifest['instruments'].items():
+        with np.load(os.path.join(shard_dir, filename)) as npz:
+            arrays = {name: npz[name] for name in npz.files if not name.startswith('durations_')}
+            duration_arrays = {name[len('durations_'):]: npz[name] for name in npz.files if name.startswith('durations_')}
+        yield instr_name, arrays, duration_arrays
+
+def has_shard(shard_dir: str) -> bool:
+    """
+    Check whether a directory contains a saved shard.
+    :param shard_dir: Directory to check.
+    :return: True if save_shard() completed in the directory.
+    """
+    return os.path.isfile(os.path.join(shard_dir, 'shard.json'))
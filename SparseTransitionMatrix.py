@@ -0,0 +1,54 @@
+import numpy as np
+
+class SparseTransitionMatrix:
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, counts: np.ndarray, n_states: int, laplace_smoothing: float = 1.0,
+                 row_totals: np.ndarray | None = None):
+        """
+        Transition counts between integer-coded states stored in CSR form.
+        Laplace smoothing is applied implicitly: P(j | i) = (counts[i, j] + laplace_smoothing) / (row_total[i] + laplace_smoothing * n_states),
+        so the smoothed matrix is never materialized.
+        :param indptr: Row pointer array of length n_states + 1.
+        :param indices: Column (next state) index of every stored count, sorted within each row.
+        :param counts: Observed transition count of every stored entry.
+        :param n_states: Number of states.
+        :param laplace_smoothing: Pseudo-count added to every cell.
+        :param row_totals: Precomputed sum of the counts of every row, e.g. when loading a saved model. Computed if None.
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+        self.n_states = n_states
+        self.laplace_smoothing = laplace_smoothing
+
+        if row_totals is None:
+            cumulative_counts = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=cumulative_counts[1:])
+            row_totals = cumulative_counts[indptr[1:]] - cumulative_counts[indptr[:-1]]
+        self.row_totals = row_totals
+
+    @classmethod
+    def from_counts(cls, current_ids: np.ndarray, next_ids: np.ndarray, counts: np.ndarray, n_states: int, laplace_smoothing: float = 1.0) -> 'SparseTransitionMatrix':
+        """
+        Build the matrix from already counted, distinct (current, next) pairs.
+        :param current_ids: State id of every pair's source.
+        :param next_ids: State id of every pair's target.
+        :param counts: Number of times every pair was observed.
+        :param n_states: Number of states.
+        :param laplace_smoothing: Pseudo-count added to every cell.
+        :return: SparseTransitionMatrix holding the counts.
+        """
+        order = np.lexsort((next_ids, current_ids))
+        rows = current_ids[order]
+
+        indptr = np.zeros(n_states + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_states), out=indptr[1:])
+
+        return cls(indptr, next_ids[order].astype(np.int32), counts[order].astype(np.int64), n_states, laplace_smoothing)
+
+    @property
+    def nnz(self) -> int:
+        return len(self.indices)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.n_states, self.n_states
@@ -0,0 +1,73 @@
+import os
+import json
+import hashlib
+import numpy as np
+from Vocabulary import array_to_masks, masks_to_array
+
+class TokenCache:
+    def __init__(self, cache_dir: str, tokenizer_version: str, use_content_hash: bool = False):
+        """
+        On-disk cache of the per-instrument token streams extracted from MIDI files. Tokens are stored as their
+        pitch-set masks rather than vocabulary ids, so entries stay valid for every vocabulary.
+        :param cache_dir: Directory the cache entries are stored in. Created if missing.
+        :param tokenizer_version: Version of the tokenizer; entries from other versions are never returned.
+        :param use_content_hash: Key entries by a hash of the file contents instead of its modification time.
+        """
+        self._cache_dir = cache_dir
+        self._tokenizer_version = tokenizer_version
+        self._use_content_hash = use_content_hash
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, midi_path: str) -> str:
+        """
+        Build the cache key of a MIDI file from its path, size, modification time (or content hash) and the tokenizer version.
+        :param midi_path: Path to the MIDI file.
+        :return: Hex digest identifying the current state of the file.
+        """
+        stat = os.stat(midi_path)
+        hasher = hashlib.sha256()
+        hasher.update(self._tokenizer_version.encode())
+        hasher.update(os.path.abspath(midi_path).encode())
+        hasher.update(str(stat.st_size).encode())
+
+        if self._use_content_hash:
+            with open(midi_path, 'rb') as f:
+                hasher.update(hashlib.sha256(f.read()).digest())
+        else:
+            hasher.update(str(stat.st_mtime_ns).encode())
+
+        return hasher.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, key[:2], key + '.json')
+
+    def get(self, midi_path: str) -> list[tuple[str, np.ndarray, np.ndarray]] | None:
+        """
+        Look up the token streams of a MIDI file.
+        :param midi_path: Path to the MIDI file.
+        :return: List of (instrument name, pitch-set masks, durations) tuples, or None if the file is not cached or has changed.
+        """
+        try:
+            with open(self._entry_path(self._key(midi_path)), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        return [(instr_name, masks_to_array(masks), np.array(durations, dtype=np.int32))
+                for instr_name, masks, durations in entry['parts']]
+
+    def put(self, midi_path: str, parts: list[tuple[str, np.ndarray, np.ndarray]]) -> None:
+        """
+        Store the token streams of a MIDI file. The entry is written atomically so concurrent readers never see partial files.
+        :param midi_path: Path to the MIDI file.
+        :param parts: List of (instrument name, pitch-set masks, durations) tuples extracted from the file.
+        :return: None
+        """
+        entry_path = self._entry_path(self._key(midi_path))
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'path': midi_path, 'parts': [(instr_name, array_to_masks(masks), durations.tolist())
+                                                    for instr_name, masks, durations in parts]}, f)
+        os.replace(tmp_path, entry_path)
@@ -0,0 +1,221 @@
+import numpy as np
+from ContextIndex import ContextIndex
+from SparseTransitionMatrix import SparseTransitionMatrix
+from Vocabulary import Vocabulary
+
+# Pair codes pack (current_id, next_id) token ids into one int64 with a fixed shift, so growing the vocabulary never invalidates them
+_PAIR_SHIFT = 32
+_PAIR_MASK = (1 << _PAIR_SHIFT) - 1
+
+# Pending contributions are merged once they hold this many entries and at least as many as the merged counts
+_MIN_MERGE_SIZE = 1 << 16
+
+def _merge_ngrams(ngrams: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sum the counts of equal n-grams and drop the ones whose counts cancelled out.
+    :param ngrams: Array of shape (n, order + 1) of state ids.
+    :param counts: Count of every row of ngrams.
+    :return: Tuple of (distinct n-grams sorted lexicographically, their summed counts).
+    """
+    unique_ngrams, inverse = np.unique(ngrams, axis=0, return_inverse=True)
+    merged_counts = np.zeros(len(unique_ngrams), dtype=np.int64)
+    np.add.at(merged_counts, inverse.ravel(), counts)
+
+    nonzero = merged_counts != 0
+    return unique_ngrams[nonzero], merged_counts[nonzero]
+
+class TransitionCounts:
+    def __init__(self, vocabulary: Vocabulary | None, max_order: int = 1):
+        """
+        Raw transition and starting counts of one instrument, over the token ids of a shared vocabulary.
+        The vocabulary only grows, so counts can be merged in (or subtracted) file by file and normalized
+        whenever a model is needed.
+        :param vocabulary: Vocabulary the token ids belong to. None for tokens that are plain non-negative
+                           integers, such as durations, which are ordered by value.
+        :param max_order: Highest Markov order counted. Orders above 1 also count every context of
+                          2..max_order previous states together with the state that followed it.
+        """
+        self.max_order = max_order
+        self.vocabulary = vocabulary
+        self._pair_codes = np.empty(0, dtype=np.int64)
+        self._pair_counts = np.empty(0, dtype=np.int64)
+        self._starting_counts = np.empty(0, dtype=np.int64)
+        self._ngrams = {order: (np.empty((0, order + 1), dtype=np.int64), np.empty(0, dtype=np.int64))
+                        for order in range(2, max_order + 1)}
+        self._pending = []
+        self._pending_size = 0
+
+    def count(self, parts: list[np.ndarray]) -> tuple:
+        """
+        Count the transitions of some parts without adding them yet.
+        :param parts: List of token id arrays, each with at least two elements.
+        :return: Contribution tuple of (distinct pair codes, their counts, starting state ids, {order: (distinct n-grams, their counts)})
+                 to pass to add() or subtract().
+        """
+        pair_codes = []
+        ngrams = {order: [] for order in self._ngrams}
+        starting_ids = np.empty(len(parts), dtype=np.int64)
+
+        for i, token_ids in enumerate(parts):
+            state_ids = token_ids.astype(np.int64)
+            pair_codes.append((state_ids[:-1] << _PAIR_SHIFT) | state_ids[1:])
+            starting_ids[i] = state_ids[0]
+
+            for order in ngrams:
+                if len(state_ids) > order:
+                    ngrams[order].append(np.lib.stride_tricks.sliding_window_view(state_ids, order + 1))
+
+        unique_codes, counts = np.unique(np.concatenate(pair_codes) if pair_codes else np.empty(0, dtype=np.int64),
+                                         return_counts=True)
+
+        ngram_counts = {}
+        for order, windows in ngrams.items():
+            all_windows = np.concatenate(windows) if windows else np.empty((0, order + 1), dtype=np.int64)
+            ngram_counts[order] = _merge_ngrams(all_windows, np.ones(len(all_windows), dtype=np.int64))
+
+        return unique_codes, counts.astype(np.int64), starting_ids, ngram_counts
+
+    def add(self, contribution: tuple, sign: int = 1) -> None:
+        """
+        Merge a contribution from count() into the counts. Pair and n-gram counts are buffered and merged in
+        batches at least as large as the counts merged so far, so adding a corpus file by file costs
+        O(n log n) instead of re-merging everything for every file.
+        :param contribution: Tuple of (pair codes, counts, starting state ids, n-gram counts by order).
+        :param sign: 1 to add the contribution, -1 to remove it.
+        :return: None
+        """
+        pair_codes, counts, starting_ids, ngram_counts = contribution
+
+        n_ids = int(starting_ids.max(initial=-1)) + 1
+        if len(self._starting_counts) < n_ids:
+            self._starting_counts = np.concatenate(
+                (self._starting_counts, np.zeros(n_ids - len(self._starting_counts), dtype=np.int64)))
+        np.add.at(self._starting_counts, starting_ids, sign)
+
+        self._pending.append((pair_codes, sign * counts,
+                              {order: (ngrams, sign * ngram_counts_of_order)
+                               for order, (ngrams, ngram_counts_of_order) in ngram_counts.items()}))
+        self._pending_size += len(pair_codes) + sum(len(ngrams) for ngrams, _ in ngram_counts.values())
+
+        merged_size = len(self._pair_codes) + sum(len(ngrams) for ngrams, _ in self._ngrams.values())
+        if self._pending_size >= max(merged_size, _MIN_MERGE_SIZE):
+            self._merge_pending()
+
+    def _merge_pending(self) -> None:
+        """
+        Merge the buffered contributions into the pair and n-gram counts.
+        :return: None
+        """
+        if not self._pending:
+            return
+
+        all_codes = np.concatenate([self._pair_codes] + [pair_codes for pair_codes, _, _ in self._pending])
+        all_counts = np.concatenate([self._pair_counts] + [counts for _, counts, _ in self._pending])
+        unique_codes, inverse = np.unique(all_codes, return_inverse=True)
+        merged_counts = np.zeros(len(unique_codes), dtype=np.int64)
+        np.add.at(merged_counts, inverse, all_counts)
+
+        # Pairs whose contributions were all removed are dropped
+        nonzero = merged_counts != 0
+        self._pair_codes = unique_codes[nonzero]
+        self._pair_counts = merged_counts[nonzero]
+
+        for order, (stored_ngrams, stored_counts) in self._ngrams.items():
+            pending_ngrams = [ngram_counts[order] for _, _, ngram_counts in self._pending if order in ngram_counts]
+            self._ngrams[order] = _merge_ngrams(np.concatenate([stored_ngrams] + [ngrams for ngrams, _ in pending_ngrams]),
+                                                np.concatenate([stored_counts] + [counts for _, counts in pending_ngrams]))
+
+        self._pending = []
+        self._pending_size = 0
+
+    def subtract(self, contribution: tuple) -> None:
+        """
+        Remove a contribution previously merged with add().
+        :param contribution: Tuple of (pair codes, counts, starting state ids, n-gram counts by order).
+        :return: None
+        """
+        self.add(contribution, sign=-1)
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """
+        The raw counts as named arrays, e.g. to save them with np.savez(). Token ids refer to this instance's vocabulary.
+        :return: Dict of 'pair_codes', 'pair_counts', 'starting_counts' and 'ngrams_<order>', 'ngram_counts_<order>'
+                 for orders 2..max_order.
+        """
+        self._merge_pending()
+        arrays = {'pair_codes': self._pair_codes, 'pair_counts': self._pair_counts, 'starting_counts': self._starting_counts}
+        for order, (ngrams, ngram_counts) in self._ngrams.items():
+            arrays[f'ngrams_{order}'] = ngrams
+            arrays[f'ngram_counts_{order}'] = ngram_counts
+        return arrays
+
+    @staticmethod
+    def contribution_from_arrays(arrays, max_order: int = 1, id_map: np.ndarray | None = None) -> tuple:
+        """
+        Turn counts saved with to_arrays() into a contribution, e.g. to merge counts made by another process.
+        :param arrays: Mapping of the arrays returned by to_arrays(), e.g. a loaded .npz file.
+        :param max_order: Highest order of the counts the contribution is added to. Higher orders are dropped.
+        :param id_map: Token id in the target vocabulary of every token id of the saved counts. None keeps the ids.
+        :return: Contribution tuple to pass to add() or subtract().
+        :raises ValueError: If the saved counts lack an order up to max_order.
+        """
+        map_ids = (lambda ids: id_map.astype(np.int64)[ids]) if id_map is not None else (lambda ids: ids)
+
+        pair_codes = np.asarray(arrays['pair_codes'], dtype=np.int64)
+        pair_codes = (map_ids(pair_codes >> _PAIR_SHIFT) << _PAIR_SHIFT) | map_ids(pair_codes & _PAIR_MASK)
+
+        # add() counts every starting id once, so ids are repeated by their counts
+        starting_counts = np.asarray(arrays['starting_counts'], dtype=np.int64)
+        starting_ids = np.flatnonzero(starting_counts)
+        starting_ids = map_ids(np.repeat(starting_ids, starting_counts[starting_ids]))
+
+        ngram_counts = {}
+        for order in range(2, max_order + 1):
+            if f'ngrams_{order}' not in arrays:
+                raise ValueError(f'Order {order} requested, but the saved counts only go up to a lower order')
+            ngram_counts[order] = (map_ids(np.asarray(arrays[f'ngrams_{order}'], dtype=np.int64)),
+                                   np.asarray(arrays[f'ngram_counts_{order}'], dtype=np.int64))
+
+        return pair_codes, np.asarray(arrays['pair_counts'], dtype=np.int64), starting_ids, ngram_counts
+
+    @property
+    def n_transitions(self) -> int:
+        self._merge_pending()
+        return int(self._pair_counts.sum())
+
+    def normalize(self, laplace_smoothing: float = 1.0, order: int = 1) -> tuple[np.ndarray, SparseTransitionMatrix, np.ndarray, list[ContextIndex]]:
+        """
+        Build the model parameters from the counts. Only states that still occur are kept, ordered by their
+        pitch sets (or values), so the result does not depend on the order in which files were added.
+        :param laplace_smoothing: Pseudo-count added to every first-order transition.
+        :param order: Markov order of the model, at most max_order.
+        :return: Tuple of (token id of every state, first-order transition matrix, starting probabilities,
+                 context indices of orders 2..order).
+        """
+        if order > self.max_order:
+            raise ValueError(f'Order {order} requested, but only orders up to {self.max_order} were counted')
+        self._merge_pending()
+
+        current_ids = self._pair_codes >> _PAIR_SHIFT
+        next_ids = self._pair_codes & _PAIR_MASK
+        used_ids = np.unique(np.concatenate((current_ids, next_ids, np.flatnonzero(self._starting_counts))))
+
+        # np.unique already sorted the ids by value
+        sort_order = self.vocabulary.sort_order(used_ids) if self.vocabulary is not None else np.arange(len(used_ids))
+        states = used_ids[sort_order].astype(np.int32)
+
+        remap = np.full(int(used_ids.max(initial=-1)) + 1, -1, dtype=np.int64)
+        remap[used_ids[sort_order]] = np.arange(len(states))
+
+        transition_matrix = SparseTransitionMatrix.from_counts(remap[current_ids], remap[next_ids], self._pair_counts,
+                                                               len(states), laplace_smoothing)
+
+        starting_counts = np.zeros(len(states), dtype=np.int64)
+        starting_ids = used_ids[used_ids < len(self._starting_counts)]
+        starting_counts[remap[starting_ids]] = self._starting_counts[starting_ids]
+
+        # Every n-gram is made of counted pairs, so all of its states are in use
+        context_indices = [ContextIndex.from_ngrams(remap[self._ngrams[context_order][0]], self._ngrams[context_order][1])
+                           for context_order in range(2, order + 1)]
+
+        return states, transition_matrix, starting_counts / starting_counts.sum(), context_indices
@@ -0,0 +1,168 @@
+import numpy as np
+
+# Pitch sets are 128-bit masks over the MIDI pitches, stored as two uint64 words: pitches 0-63, then 64-127
+N_PITCHES = 128
+_WORD_BITS = 64
+_WORD_MASK = (1 << _WORD_BITS) - 1
+
+# A rest sounds no pitches
+REST_MASK = 0
+
+# Durations are counted in twelfths of a quarter note, which represent sixteenths and eighth-triplets exactly.
+# Longer durations (e.g. multi-bar rests) are clipped to four 4/4 bars.
+DURATION_RESOLUTION = 12
+MAX_DURATION = 16 * DURATION_RESOLUTION
+
+def quarter_lengths_to_durations(quarter_lengths) -> np.ndarray:
+    """
+    Quantize durations given in quarter notes to duration units.
+    :param quarter_lengths: Durations in quarter notes.
+    :return: Array of durations in units of 1 / DURATION_RESOLUTION quarter notes, between 1 and MAX_DURATION.
+    """
+    durations = np.rint(np.asarray(quarter_lengths, dtype=np.float64) * DURATION_RESOLUTION)
+    return np.clip(durations, 1, MAX_DURATION).astype(np.int32)
+
+def pitches_to_mask(pitches) -> int:
+    """
+    Encode a set of MIDI pitches as a bitmask.
+    :param pitches: Iterable of MIDI numbers (0-127). Empty for a rest.
+    :return: Integer with bit p set for every pitch p.
+    """
+    mask = 0
+    for pitch in pitches:
+        mask |= 1 << pitch
+    return mask
+
+def mask_to_pitches(mask: int) -> tuple[int, ...]:
+    """
+    Decode a bitmask into its MIDI pitches.
+    :param mask: Pitch-set bitmask.
+    :return: Sorted tuple of MIDI numbers. Empty for a rest.
+    """
+    return tuple(pitch for pitch in range(N_PITCHES) if mask >> pitch & 1)
+
+def masks_to_array(masks: list[int]) -> np.ndarray:
+    """
+    Pack bitmasks into an array of two uint64 words per mask.
+    :param masks: List of pitch-set bitmasks.
+    :return: Array of shape (len(masks), 2) holding the low and high word of every mask.
+    """
+    array = np.empty((len(masks), 2), dtype=np.uint64)
+    array[:, 0] = [mask & _WORD_MASK for mask in masks]
+    array[:, 1] = [mask >> _WORD_BITS for mask in masks]
+    return array
+
+def array_to_masks(array: np.ndarray) -> list[int]:
+    """
+    Unpack an array of two uint64 words per mask into bitmasks.
+    :param array: Array of shape (n, 2), as returned by masks_to_array().
+    :return: List of pitch-set bitmasks.
+    """
+    return [low | high << _WORD_BITS for low, high in array.tolist()]
+
+def masks_to_sounding(masks: np.ndarray) -> np.ndarray:
+    """
+    Unpack an array of pitch-set masks into one flag per pitch.
+    :param masks: Array of shape (n, 2), as returned by masks_to_array().
+    :return: Boolean array of shape (n, N_PITCHES), True where the pitch sounds.
+    """
+    # Bit p of the little-endian 128-bit mask is pitch p
+    sounding = np.unpackbits(np.ascontiguousarray(masks, dtype='<u8').view(np.uint8), axis=1, bitorder='little')
+    return sounding.reshape(len(masks), N_PITCHES).astype(bool)
+
+def token_to_mask(token: str) -> int:
+    """
+    Encode a music element string ('60', '60,64,67' or '-1' for a rest), as used by saved models of format 1 and 2.
+    :param token: Music element string.
+    :return: Pitch-set bitmask.
+    """
+    return REST_MASK if token == '-1' else pitches_to_mask(int(midi_str) for midi_str in token.split(','))
+
+class Vocabulary:
+    def __init__(self):
+        """
+        Interned table of pitch sets. Every distinct pitch set gets a dense int id the first time it is seen,
+        and ids never change, so one vocabulary is shared by the trainer, the models and the generator.
+        Masks are kept in an array indexed by id, so decoding ids is a single lookup.
+        """
+        self._ids = {}
+        self._masks = np.empty((64, 2), dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def masks(self) -> np.ndarray:
+        """
+        Pitch-set mask of every token id, as an array of shape (len(self), 2).
+        """
+        return self._masks[:len(self._ids)]
+
+    def intern(self, mask: int) -> int:
+        """
+        Get the id of a pitch set, adding it to the vocabulary if unseen.
+        :param mask: Pitch-set bitmask.
+        :return: Token id.
+        """
+        token_id = self._ids.get(mask)
+        if token_id is None:
+            token_id = len(self._ids)
+            if token_id == len(self._masks):
+                self._masks = np.concatenate((self._masks, np.empty_like(self._masks)))
+            self._masks[token_id] = (mask & _WORD_MASK, mask >> _WORD_BITS)
+            self._ids[mask] = token_id
+        return token_id
+
+    def lookup(self, mask: int) -> int | None:
+        """
+        Get the id of a pitch set without adding it.
+        :param mask: Pitch-set bitmask.
+        :return: Token id, or None if the pitch set is not in the vocabulary.
+        """
+        return self._ids.get(mask)
+
+    def intern_masks(self, masks: np.ndarray) -> np.ndarray:
+        """
+        Get the ids of many pitch sets at once. Only distinct masks are looked up.
+        :param masks: Array of shape (n, 2), as returned by masks_to_array().
+        :return: Array of n token ids.
+        """
+        if len(masks) == 0:
+            return np.empty(0, dtype=np.int32)
+
+        unique_masks, inverse = np.unique(masks, axis=0, return_inverse=True)
+        unique_ids = np.array([self.intern(mask) for mask in array_to_masks(unique_masks)], dtype=np.int32)
+        return unique_ids[inverse.ravel()]
+
+    def intern_tokens(self, tokens) -> np.ndarray:
+        """
+        Get the ids of music element strings, e.g. the states of models saved in format 1 or 2.
+        :param tokens: Iterable of music element strings.
+        :return: Array of token ids.
+        """
+        return np.array([self.intern(token_to_mask(str(token))) for token in tokens], dtype=np.int32)
+
+    def pitches(self, token_id: int) -> tuple[int, ...]:
+        """
+        :param token_id: Token id.
+        :return: Sorted MIDI numbers of the pitch set. Empty for a rest.
+        """
+        low, high = self._masks[token_id].tolist()
+        return mask_to_pitches(low | high << _WORD_BITS)
+
+    def sort_order(self, token_ids: np.ndarray) -> np.ndarray:
+        """
+        Order token ids by their pitch sets, so results do not depend on the order tokens were first seen in.
+        :param token_ids: Array of token ids.
+        :return: Indices that sort token_ids by mask value.
+        """
+        masks = self._masks[token_ids]
+        return np.lexsort((masks[:, 0], masks[:, 1]))
+
+    def to_strings(self, token_ids: np.ndarray) -> list[str]:
+        """
+        Readable music elements of token ids: '60' for a note, '60,64,67' for a chord and '-1' for a rest.
+        :param token_ids: Array of token ids.
+        :return: List of music element strings.
+        """
+        return [','.join(str(pitch) for pitch in self.pitches(token_id)) or '-1' for token_id in np.ravel(token_ids).tolist()]
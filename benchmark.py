@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import music21
+import numpy as np
+import Instrumentation
+from Instrumentation import JsonLinesSink, LoggingSink, PrometheusSink, peak_rss_mb
+from MusicDataTrainer import MusicDataTrainer, find_midi_files
+from MidiWriter import PITCHED_CHANNELS, TICKS_PER_QUARTER, encode_variable_length, write_midi_file
+from MusicGenerator import MusicGenerator
+
+# Programs the synthetic parts cycle through (piano, strings, flute, guitar, ...)
+SYNTHETIC_PROGRAMS = (0, 40, 73, 24, 32, 56, 68, 19)
+
+def _synthetic_track(rng: np.random.Generator, program: int, channel: int, n_events: int, chord_density: float,
+                     rest_probability: float = 0.1) -> bytes:
+    """
+    Build the MTrk chunk of a random-walk melody with chords and rests.
+    :param rng: Random generator.
+    :param program: General MIDI program of the track.
+    :param channel: MIDI channel of the track.
+    :param n_events: Number of notes, chords and rests.
+    :param chord_density: Probability of an onset being a chord instead of a single note.
+    :param rest_probability: Probability of an event being a rest.
+    :return: Track chunk bytes.
+    """
+    events = bytearray(encode_variable_length(0) + bytes([0xC0 | channel, program]))
+    pitch = int(rng.integers(48, 72))
+    pending_delta = 0
+
+    for _ in range(n_events):
+        duration = int(rng.choice([TICKS_PER_QUARTER // 2, TICKS_PER_QUARTER, TICKS_PER_QUARTER * 2]))
+
+        if rng.random() < rest_probability:
+            pending_delta += duration
+            continue
+
+        pitch = int(np.clip(pitch + rng.integers(-4, 5), 36, 84))
+        pitches = [pitch]
+        if rng.random() < chord_density:
+            pitches += [pitch + interval for interval in rng.choice([3, 4, 7, 10, 12], size=int(rng.integers(1, 4)), replace=False)]
+
+        for i, p in enumerate(pitches):
+            events += encode_variable_length(pending_delta if i == 0 else 0) + bytes([0x90 | channel, p, 80])
+        pending_delta = 0
+        for i, p in enumerate(pitches):
+            events += encode_variable_length(duration if i == 0 else 0) + bytes([0x80 | channel, p, 0])
+
+    events += encode_variable_length(pending_delta) + b'\xFF\x2F\x00'
+    return b'MTrk' + len(events).to_bytes(4, 'big') + bytes(events)
+
+def build_synthetic_corpus(directory: str, n_files: int, n_parts: int = 4, n_events: int = 200,
+                           chord_density: float = 0.3, seed: int = 0) -> list[str]:
+    """
+    Write a reproducible corpus of random multi-part MIDI files.
+    :param directory: Directory to write the files to. Created if missing.
+    :param n_files: Number of files.
+    :param n_parts: Number of parts (tracks with their own program) per file.
+    :param n_events: Number of notes, chords and rests per part.
+    :param chord_density: Probability of an onset being a chord.
+    :param seed: Seed of the random generator.
+    :return: Paths of the written files.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+
+    for file_index in range(n_files):
+        tracks = [_synthetic_track(rng, SYNTHETIC_PROGRAMS[(file_index + part) % len(SYNTHETIC_PROGRAMS)],
+                                   PITCHED_CHANNELS[part % len(PITCHED_CHANNELS)], n_events, chord_density)
+                  for part in range(n_parts)]
+
+        path = os.path.join(directory, f'synthetic_{file_index:05d}.mid')
+        with open(path, 'wb') as f:
+            f.write(write_midi_file(tracks))
+        paths.append(path)
+
+    return paths
+
+def _time_stage(results: dict, name: str, items: int, unit: str, run, setup=None, repeats: int = 5):
+    """
+    Time one benchmark stage: one untimed warm-up run, then repeats timed runs. The median run is reported,
+    so stages far below a millisecond are not dominated by timer noise and one-off costs such as imports.
+    :param results: Dict to record the timing in, under the stage name.
+    :param name: Stage name.
+    :param items: Number of items processed by one run, for the throughput.
+    :param unit: Unit of the items.
+    :param run: Function running the stage once. Gets the result of setup if given.
+    :param setup: Function preparing fresh input for every run, outside the timer, e.g. an empty trainer.
+    :param repeats: Number of timed runs.
+    :return: Return value of the last run.
+    """
+    seconds = []
+    for repeat in range(repeats + 1):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        value = run(*args)
+        if repeat > 0:
+            seconds.append(time.perf_counter() - start)
+
+    median_seconds = float(np.median(seconds))
+    results[name] = {
+        'seconds': median_seconds,
+        'min_seconds': min(seconds),
+        'repeats': repeats,
+        'items': items,
+        'unit': unit,
+        'throughput': items / median_seconds if median_seconds > 0 else float('inf'),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    return value
+
+def benchmark_corpus(corpus_dir: str, tokenizer: str = 'music21', n_workers: int = 1, order: int = 1,
+                     length: int = 200, n_sequences: int = 64, repeats: int = 5) -> dict:
+    """
+    Time every stage of the pipeline on one corpus.
+    :param corpus_dir: Directory containing the MIDI files.
+    :param tokenizer: Tokenizer used by the trainer.
+    :param n_workers: Worker processes used for parsing.
+    :param order: Markov order of the trained models.
+    :param length: Length of the generated sequences.
+    :param n_sequences: Number of sequences generated in the batched sampling stage.
+    :param repeats: Timed runs of every stage after its warm-up run (see _time_stage()).
+    :return: Dict mapping stage names to their timings, the median of the runs.
+    """
+    results = {}
+    midi_paths = find_midi_files(corpus_dir)
+
+    # Trainers start without data, so loading and counting can be timed separately
+    def new_trainer() -> MusicDataTrainer:
+        return MusicDataTrainer(tokenizer=tokenizer, n_workers=n_workers, max_order=order, midi_paths=[])
+
+    trainer = new_trainer()
+    loaded = _time_stage(results, '_load_data', len(midi_paths), 'files',
+                         lambda: list(trainer._load_data(midi_paths)), repeats=repeats)
+
+    n_parts = sum(len(parts) for _, parts in loaded)
+    n_tokens = sum(len(masks) for _, parts in loaded for _, masks, _ in parts)
+
+    score = music21.instrument.partitionByInstrument(music21.converter.parse(midi_paths[0]))
+    _time_stage(results, '_get_music_elements', len(score.parts), 'parts',
+                lambda: [MusicDataTrainer._get_music_elements(part) for part in score.parts], repeats=repeats)
+
+    # Counting only; the files were already tokenized by the _load_data stage. Every run counts into a new trainer
+    def count_files(trainer: MusicDataTrainer) -> MusicDataTrainer:
+        for midi_path, parts in loaded:
+            trainer._add_file(midi_path, parts)
+        return trainer
+
+    trainer = _time_stage(results, 'count', n_tokens, 'tokens', count_files, setup=new_trainer, repeats=repeats)
+    del loaded
+
+    # analyze_data() only renormalizes changed instruments, so every run marks all of them as changed
+    def mark_all_dirty() -> None:
+        trainer._dirty_instruments.update(trainer._counts)
+
+    _time_stage(results, 'analyze_data', n_tokens, 'tokens', lambda _: trainer.analyze_data(order=order),
+                setup=mark_all_dirty, repeats=repeats)
+
+    models = _time_stage(results, 'train_models', len(trainer.instrument_mapping), 'instruments',
+                         trainer.train_models, repeats=repeats)
+
+    # Sampling is timed on the largest model
+    model = max(models.values(), key=lambda m: sum(m.memory_usage().values()))
+
+    _time_stage(results, 'generate_sequence', length, 'tokens',
+                lambda: model.generate_sequence(length=length, seed=0), repeats=repeats)
+    _time_stage(results, 'generate_batch', length * n_sequences, 'tokens',
+                lambda: model.generate_batch(n_sequences, length=length, seed=0), repeats=repeats)
+
+    generator = MusicGenerator(data_path=corpus_dir, tokenizer=tokenizer, n_workers=n_workers, order=order)
+    # Both rendering stages generate the same parts; the warm-up run builds the models before the timed runs
+    instruments = generator.instruments[:4]
+    _time_stage(results, 'generate_music', length * len(instruments), 'tokens',
+                lambda: generator.generate_music(length=length, show=False, instruments=instruments, seed=0),
+                repeats=repeats)
+    _time_stage(results, 'generate_music_midi', length * len(instruments), 'tokens',
+                lambda: generator.generate_music(length=length, render='midi', instruments=instruments, seed=0),
+                repeats=repeats)
+
+    results['corpus'] = {'files': len(midi_paths), 'parts': n_parts, 'tokens': n_tokens,
+                         'instruments': len(trainer.instrument_mapping)}
+    return results
+
+def compare(current: dict, baseline: dict, tolerance: float = 0.2) -> list[str]:
+    """
+    Find stages that got slower than a baseline run, comparing the median seconds of their runs.
+    :param current: Benchmark report of this run.
+    :param baseline: Benchmark report of an earlier run.
+    :param tolerance: Allowed relative slowdown before a stage counts as a regression.
+    :return: Descriptions of the regressed stages.
+    """
+    regressions = []
+
+    for size, stages in current['runs'].items():
+        for stage, timing in stages.items():
+            baseline_timing = baseline.get('runs', {}).get(size, {}).get(stage)
+            if stage == 'corpus' or baseline_timing is None:
+                continue
+            if timing['seconds'] > baseline_timing['seconds'] * (1 + tolerance):
+                regressions.append(f"{size} files / {stage}: {baseline_timing['seconds']:.4f}s -> {timing['seconds']:.4f}s")
+
+    return regressions
+
+def scaling_exponents(runs: dict) -> dict[str, float]:
+    """
+    Fit how the time of every stage grows with the corpus size: the slope of log(median seconds) over log(files).
+    1.0 means linear scaling; stages with constant work per run stay near 0.
+    :param runs: Benchmark results keyed by corpus size.
+    :return: Dict mapping stage names to their fitted exponents. Empty if fewer than two sizes were run.
+    """
+    if len(runs) < 2:
+        return {}
+
+    sizes = np.log([int(size) for size in runs])
+    exponents = {}
+
+    for stage in next(iter(runs.values())):
+        if stage == 'corpus':
+            continue
+        seconds = np.log([max(results[stage]['seconds'], 1e-9) for results in runs.values()])
+        exponents[stage] = float(np.polyfit(sizes, seconds, 1)[0])
+
+    return exponents
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MIDI ingestion, training, sampling and rendering on a synthetic corpus.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 40, 160], help='Corpus sizes (file counts) to run')
+    parser.add_argument('--parts', type=int, default=4, help='Parts per file')
+    parser.add_argument('--events', type=int, default=200, help='Notes, chords and rests per part')
+    parser.add_argument('--chord-density', type=float, default=0.3)
+    parser.add_argument('--tokenizer', default='music21')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--order', type=int, default=1)
+    parser.add_argument('--length', type=int, default=200, help='Length of generated sequences')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=5, help='Timed runs of every stage after a warm-up run; the median is reported')
+    parser.add_argument('--corpus-dir', default=None, help='Where to build the corpora (a temporary directory by default)')
+    parser.add_argument('--output', default=None, help='Write the JSON report to this path')
+    parser.add_argument('--compare', default=None, help='JSON report of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--metrics-log', action='store_true', help='Log the fine-grained pipeline instrumentation')
+    parser.add_argument('--metrics-jsonl', default=None, help='Append the pipeline instrumentation events to this JSON lines file')
+    parser.add_argument('--metrics-prometheus', default=None, help='Write the aggregated instrumentation in Prometheus text format')
+    args = parser.parse_args()
+
+    sinks = []
+    if args.metrics_log:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        sinks.append(LoggingSink())
+    if args.metrics_jsonl is not None:
+        sinks.append(JsonLinesSink(args.metrics_jsonl))
+    if args.metrics_prometheus is not None:
+        sinks.append(PrometheusSink(args.metrics_prometheus))
+    if sinks:
+        Instrumentation.enable(*sinks)
+
+    report = {'config': vars(args), 'runs': {}}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base_dir = args.corpus_dir if args.corpus_dir is not None else tmp_dir
+
+        for size in args.sizes:
+            corpus_dir = os.path.join(base_dir, f'corpus_{size}_{args.parts}_{args.events}_{args.chord_density}_{args.seed}')
+            if not find_midi_files(corpus_dir):
+                build_synthetic_corpus(corpus_dir, size, n_parts=args.parts, n_events=args.events,
+                                       chord_density=args.chord_density, seed=args.seed)
+
+            print(f'Benchmarking {size} files...')
+            results = benchmark_corpus(corpus_dir, tokenizer=args.tokenizer, n_workers=args.workers,
+                                       order=args.order, length=args.length, repeats=args.repeats)
+            report['runs'][str(size)] = results
+
+            for stage, timing in results.items():
+                if stage != 'corpus':
+                    print(f"  {stage:<20} {timing['seconds']:>9.4f}s {timing['throughput']:>12.1f} {timing['unit']}/s "
+                          f"peak RSS {timing['peak_rss_mb']:.1f} MiB")
+
+    Instrumentation.disable()
+
+    report['scaling'] = scaling_exponents(report['runs'])
+    for stage, exponent in report['scaling'].items():
+        print(f'  {stage:<20} scales as files^{exponent:.2f}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
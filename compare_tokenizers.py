@@ -0,0 +1,80 @@
+import argparse
+from difflib import SequenceMatcher
+import numpy as np
+from MusicDataTrainer import _extract_parts
+from Vocabulary import array_to_masks, mask_to_pitches
+
+def _parts_by_instrument(midi_path: str, tokenizer: str) -> dict[str, tuple[list[int], np.ndarray]]:
+    """
+    Tokenize a file and join the parts of every instrument.
+    :param midi_path: Path to the MIDI file.
+    :param tokenizer: Name of the tokenizer, see MusicDataTrainer.TOKENIZERS.
+    :return: Dict mapping instrument names to (pitch-set masks, durations).
+    :raises ValueError: If the file cannot be tokenized.
+    """
+    _, parts, error, _ = _extract_parts(midi_path, tokenizer=tokenizer)
+    if error is not None:
+        raise ValueError(f'{tokenizer} tokenizer failed on {midi_path}: {error}')
+
+    joined = {}
+    for instr_name, masks, durations in parts:
+        instr_masks, instr_durations = joined.get(instr_name, ([], np.empty(0, dtype=np.int32)))
+        joined[instr_name] = (instr_masks + array_to_masks(masks), np.concatenate((instr_durations, durations)))
+    return joined
+
+def compare_tokenizers(midi_path: str) -> list[dict]:
+    """
+    Diff the tokens of the 'music21' and 'midi' tokenizers on one file, instrument by instrument.
+    The token streams are expected to be close, not identical (see MidiTokenizer.iter_midi_tokens()).
+    :param midi_path: Path to the MIDI file.
+    :return: List of dicts, one per instrument found by either tokenizer, with the token counts of both,
+             the number of tokens in matching runs, how many of those also have equal durations, and the
+             first differing position with the pitches both tokenizers produced there.
+    """
+    reference = _parts_by_instrument(midi_path, 'music21')
+    direct = _parts_by_instrument(midi_path, 'midi')
+    empty = ([], np.empty(0, dtype=np.int32))
+    rows = []
+
+    for instr_name in list(reference) + [instr_name for instr_name in direct if instr_name not in reference]:
+        reference_masks, reference_durations = reference.get(instr_name, empty)
+        direct_masks, direct_durations = direct.get(instr_name, empty)
+        blocks = SequenceMatcher(None, reference_masks, direct_masks, autojunk=False).get_matching_blocks()
+
+        matching = sum(block.size for block in blocks)
+        matching_durations = sum(int((reference_durations[block.a:block.a + block.size] ==
+                                      direct_durations[block.b:block.b + block.size]).sum()) for block in blocks)
+        first_difference = next((i for i, (a, b) in enumerate(zip(reference_masks, direct_masks)) if a != b),
+                                None if len(reference_masks) == len(direct_masks) else min(len(reference_masks), len(direct_masks)))
+
+        rows.append({
+            'instrument': instr_name,
+            'music21_tokens': len(reference_masks),
+            'midi_tokens': len(direct_masks),
+            'matching_tokens': matching,
+            'matching_durations': matching_durations,
+            'first_difference': first_difference,
+            'music21_pitches': (mask_to_pitches(reference_masks[first_difference])
+                                if first_difference is not None and first_difference < len(reference_masks) else None),
+            'midi_pitches': (mask_to_pitches(direct_masks[first_difference])
+                             if first_difference is not None and first_difference < len(direct_masks) else None),
+        })
+
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-check the 'midi' tokenizer against the 'music21' tokenizer on MIDI files.")
+    parser.add_argument('midi_paths', nargs='+')
+    args = parser.parse_args()
+
+    for midi_path in args.midi_paths:
+        print(midi_path)
+        print(f"  {'instrument':<30} {'music21':>8} {'midi':>8} {'matching':>9} {'durations':>10}  first difference")
+        for row in compare_tokenizers(midi_path):
+            difference = ('-' if row['first_difference'] is None else
+                          f"{row['first_difference']}: {row['music21_pitches']} vs {row['midi_pitches']}")
+            print(f"  {row['instrument']:<30} {row['music21_tokens']:>8} {row['midi_tokens']:>8} "
+                  f"{row['matching_tokens']:>9} {row['matching_durations']:>10}  {difference}")
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,9 @@
-from DataTrainer import DataTrainer
+from MusicDataTrainer import MusicDataTrainer
 
 def main():
-    dt = DataTrainer(data_path='MIDI_files')
+    dt = MusicDataTrainer(data_path='MIDI_files')
 
-    print(dt.all_instruments)
+    print(dt.instrument_mapping)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,56 @@
+import argparse
+import time
+from MusicDataTrainer import MusicDataTrainer
+
+def report_orders(trainer: MusicDataTrainer, max_order: int, length: int = 200, n_sequences: int = 64) -> list[dict]:
+    """
+    Measure model memory and sampling latency of every instrument for orders 1..max_order.
+    :param trainer: Trainer constructed with max_order at least max_order.
+    :param max_order: Highest order to report.
+    :param length: Length of the sequences generated for timing.
+    :param n_sequences: Number of sequences generated per batch for timing.
+    :return: List of dicts with order, instrument, bytes per order and microseconds per generated step.
+    """
+    rows = []
+
+    for order in range(1, max_order + 1):
+        trainer.analyze_data(order=order)
+        models = trainer.train_models()
+
+        for instr_name, model in models.items():
+            start = time.perf_counter()
+            model.generate_batch(n_sequences, length=length, seed=0)
+            batch_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            model.generate_sequence(length=length)
+            sequence_seconds = time.perf_counter() - start
+
+            rows.append({
+                'order': order,
+                'instrument': instr_name,
+                'bytes_by_order': model.memory_usage(),
+                'total_bytes': sum(model.memory_usage().values()),
+                'us_per_step_single': 1e6 * sequence_seconds / length,
+                'us_per_step_batched': 1e6 * batch_seconds / (length * n_sequences),
+            })
+
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Report memory footprint and sampling latency per Markov order.')
+    parser.add_argument('data_path', nargs='?', default='MIDI_files')
+    parser.add_argument('--max-order', type=int, default=4)
+    parser.add_argument('--length', type=int, default=200)
+    parser.add_argument('--tokenizer', default='music21')
+    args = parser.parse_args()
+
+    trainer = MusicDataTrainer(data_path=args.data_path, tokenizer=args.tokenizer, max_order=args.max_order)
+
+    print(f"{'order':>5} {'instrument':<30} {'bytes':>12} {'us/step':>10} {'us/step (batch)':>16}")
+    for row in report_orders(trainer, args.max_order, length=args.length):
+        print(f"{row['order']:>5} {row['instrument']:<30} {row['total_bytes']:>12} "
+              f"{row['us_per_step_single']:>10.2f} {row['us_per_step_batched']:>16.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import numpy as np
 import os
+from concurrent.futures import ProcessPoolExecutor
 import music21
 from music21 import chord, note
 from music21.stream import Score, Part, Opus
@@ -113,22 +114,46 @@ def extract_notes(scores: list[Score | Part | Opus]):
     
     return note_T_matrix, note_to_index, index_to_note
 
-def get_score(dir_path):
+def _parse_file(midi_path: str):
+    """
+    Parse a single MIDI file, returning the error message instead of raising.
+
+    :param midi_path: path to MIDI file
+    """
+    try:
+        return music21.converter.parse(midi_path), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+def get_score(dir_path, n_workers: int | None = 1, chunk_size: int = 4):
     """
     Get music21 score from MIDI file.
     
     :param dir_path: path to MIDI file
+    :param n_workers: number of worker processes used for parsing, None uses all CPUs
+    :param chunk_size: number of files submitted to a worker at once
     """
     return_list = []
+    midi_paths = []
 
     path = os.fsencode(dir_path)
-    for file in os.listdir(path):
+    for file in sorted(os.listdir(path)):
         filename = os.fsdecode(file)
         if filename.endswith('.mid') or filename.endswith('.midi'):
             print(f'Parsing file: {filename}')
-            midi_path = os.path.join(dir_path, filename)
-            score = music21.converter.parse(midi_path)
-            return_list.append(score)
+            midi_paths.append(os.path.join(dir_path, filename))
+
+    if n_workers is None or n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_parse_file, midi_paths, chunksize=chunk_size))
+    else:
+        results = [_parse_file(midi_path) for midi_path in midi_paths]
+
+    for midi_path, (score, error) in zip(midi_paths, results):
+        if error is not None:
+            print(f'Skipping file {midi_path}: {error}')
+            continue
+        return_list.append(score)
 
     return return_list
 
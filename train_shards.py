@@ -0,0 +1,54 @@
+import argparse
+from ModelStore import save_models
+from MusicDataTrainer import MusicDataTrainer, find_midi_files
+from ShardStore import split_shards
+
+def count_shard(args) -> None:
+    """
+    Map step: count one shard of the corpus and save its counts.
+    """
+    shard = split_shards(find_midi_files(args.data_path), args.n_shards)[args.shard_index]
+    print(f'Counting shard {args.shard_index} of {args.n_shards}: {len(shard)} files')
+    trainer = MusicDataTrainer(data_path=args.data_path, n_workers=args.workers, cache_dir=args.cache_dir,
+                               tokenizer=args.tokenizer, max_order=args.max_order, midi_paths=shard)
+    trainer.save_counts(args.shard_dir)
+
+def merge_shards(args) -> None:
+    """
+    Reduce step: merge the counts of all shards, train the models and save them.
+    """
+    trainer = MusicDataTrainer(tokenizer=args.tokenizer, max_order=args.order, midi_paths=[])
+    trainer.merge_counts(args.shard_dirs)
+    trainer.analyze_data(laplace_smoothing=args.laplace_smoothing, order=args.order)
+    save_models(trainer.train_models(), args.model_dir)
+    print(f'Saved models of {len(trainer.instruments)} instruments to {args.model_dir}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Train models on a sharded corpus: count every shard separately '
+                                                 '(in parallel or one after another), then merge the counts.')
+    subparsers = parser.add_subparsers(required=True)
+
+    count_parser = subparsers.add_parser('count', help='Count one shard of the corpus')
+    count_parser.add_argument('shard_dir', help='Directory to save the shard counts to')
+    count_parser.add_argument('--data-path', default='MIDI_files')
+    count_parser.add_argument('--n-shards', type=int, default=1)
+    count_parser.add_argument('--shard-index', type=int, default=0)
+    count_parser.add_argument('--tokenizer', default='music21')
+    count_parser.add_argument('--max-order', type=int, default=1)
+    count_parser.add_argument('--workers', type=int, default=1)
+    count_parser.add_argument('--cache-dir', default=None)
+    count_parser.set_defaults(run=count_shard)
+
+    merge_parser = subparsers.add_parser('merge', help='Merge shard counts and save the trained models')
+    merge_parser.add_argument('model_dir', help='Directory to save the models to')
+    merge_parser.add_argument('shard_dirs', nargs='+')
+    merge_parser.add_argument('--tokenizer', default='music21')
+    merge_parser.add_argument('--order', type=int, default=1)
+    merge_parser.add_argument('--laplace-smoothing', type=float, default=1.0)
+    merge_parser.set_defaults(run=merge_shards)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()